@@ -0,0 +1,349 @@
+#! /usr/bin/env python3
+
+import argparse
+import contextlib
+import datetime
+import http.server
+import io
+import json
+import os
+import random
+import requests
+from slack_api import open_session
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import weekly_digest
+
+# Each scenario describes a synthetic workspace and the digest arguments to run against it.  A scenario that is
+# meant to use less memory than another names it in "peak_under".
+SCENARIOS = {
+    "small": {"channels": 20, "messages": 200, "users": 50},
+    "wide": {"channels": 200, "messages": 40, "users": 200},
+    "busy": {"channels": 1, "messages": 16000, "users": 100, "thread_depth": 60},
+    "streaming": {"channels": 1, "messages": 16000, "users": 100, "thread_depth": 60, "args": ["--streaming"],
+                  "peak_under": "busy"},
+    "exact": {"channels": 1, "messages": 16000, "users": 100, "thread_depth": 60, "args": ["--fetch-all-replies"]},
+    "workers": {"channels": 40, "messages": 200, "users": 100, "args": ["--workers", "8"]},
+    "top": {"channels": 40, "messages": 200, "users": 100, "args": ["--top", "20", "--local-permalinks"]},
+}
+
+# How far under the other scenario's peak memory a "peak_under" scenario must stay
+PEAK_UNDER = 0.75
+
+DEFAULTS = {"channels": 10, "messages": 100, "users": 50, "thread_rate": 0.1, "thread_depth": 20,
+            "reaction_rate": 0.3, "reaction_skew": 1.5, "args": []}
+
+
+class Options(argparse.ArgumentParser):
+    """
+    Consolidates our argument handling.
+    """
+
+    def __init__(self):
+        super().__init__(description='Benchmark the weekly digest against synthetic workspaces.')
+        self.parsed_args = None
+
+        self.add_argument("scenarios", nargs='*', metavar="SCENARIO",
+                          help="Run only the given scenario(s) (default: all of {})".format(", ".join(SCENARIOS)))
+        self.add_argument("--latency", type=float, default=0, metavar="MS",
+                          help="Simulated latency of each API call in milliseconds (default: %(default)s)")
+        self.add_argument("--seed", type=int, default=1, metavar="N",
+                          help="Seed for generating the workspaces (default: %(default)s)")
+        self.add_argument("--baseline", default="benchmark_baseline.json", metavar="FILE",
+                          help="Fail if any scenario makes more API calls or uses more memory than recorded in " +
+                               "the given file (default: %(default)s)")
+        self.add_argument("--memory-tolerance", type=float, default=0.25, metavar="FRACTION",
+                          help="How much more peak memory than the baseline a scenario may use before failing " +
+                               "(default: %(default)s)")
+        self.add_argument("--update-baseline", action='store_true', dest='update_baseline',
+                          help="Record this run's API call counts and peak memory as the new baseline.")
+        self.add_argument("--transport", type=int, default=0, metavar="CALLS",
+                          help="Also time CALLS requests to a local HTTP server, each on its own connection and " +
+                               "over the shared keep-alive session")
+        self.add_argument("--json", metavar="FILE",
+                          help="Also write the results to the given file as JSON")
+
+    def store_args(self):
+        self.parsed_args = self.parse_args()
+        for name in self.parsed_args.scenarios:
+            if name not in SCENARIOS:
+                self.error("Unknown scenario: {}".format(name))
+        if not self.parsed_args.scenarios:
+            self.parsed_args.scenarios = list(SCENARIOS)
+
+
+class Workspace:
+    """
+    An in-process stand-in for SlackClient, serving a synthetic workspace
+    """
+
+    def __init__(self, start, end, seed, latency=0, channels=10, messages=100, users=50, thread_rate=0.1,
+                 thread_depth=20, reaction_rate=0.3, reaction_skew=1.5, **kwargs):
+        self.latency = latency
+        self.calls = {}
+        self._lock = threading.Lock()
+        self._random = random.Random(seed)
+        self.users = ["U{:05d}".format(i) for i in range(users)]
+        self.channels = {}
+        # Start a week early, so some threads reach back before the window
+        oldest = start - datetime.timedelta(days=7)
+        span = (end - oldest).total_seconds()
+        for index in range(channels):
+            channel_id = "C{:05d}".format(index)
+            times = sorted(oldest.timestamp() + self._random.random() * span for _ in range(messages))
+            self.channels[channel_id] = ("channel-{}".format(index),
+                                         self._history(times, thread_rate, thread_depth, reaction_rate, reaction_skew))
+
+    def _history(self, times, thread_rate, thread_depth, reaction_rate, reaction_skew):
+        history = []
+        open_threads = []
+        for when in times:
+            message = {"type": "message", "ts": "{:.6f}".format(when), "user": self._random.choice(self.users),
+                       "text": "Message {} ".format(len(history)) * self._random.randint(1, 20)}
+            if self._random.random() < reaction_rate:
+                count = min(50, int(self._random.paretovariate(reaction_skew)))
+                message["reactions"] = [{"name": "+1", "count": count, "users": []}]
+            open_threads = [thread for thread in open_threads if thread["reply_count"] < thread_depth]
+            if open_threads and self._random.random() < 0.5:
+                root = self._random.choice(open_threads)
+                message["thread_ts"] = root["ts"]
+                root["reply_count"] += 1
+                root["latest_reply"] = message["ts"]
+                if self._random.random() < 0.05:
+                    message["subtype"] = "thread_broadcast"
+            elif self._random.random() < thread_rate:
+                message["thread_ts"] = message["ts"]
+                message["reply_count"] = 0
+                open_threads.append(message)
+            history.append(message)
+        return history
+
+    def api_call(self, method, timeout=None, **kwargs):
+        with self._lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+        if self.latency:
+            time.sleep(self.latency)
+        handler = getattr(self, "_" + method.replace(".", "_"), None)
+        if not handler:
+            return {"ok": False, "error": "unknown_method"}
+        response = handler(**kwargs)
+        response["ok"] = True
+        return response
+
+    @staticmethod
+    def _page(items, cursor, limit):
+        start = int(cursor or 0)
+        page = {"has_more": start + limit < len(items)}
+        if page["has_more"]:
+            page["response_metadata"] = {"next_cursor": str(start + limit)}
+        return items[start:start + limit], page
+
+    def _auth_test(self):
+        return {"url": "https://synthetic.slack.com/"}
+
+    def _channels_list(self, **kwargs):
+        return {"channels": [{"id": channel_id, "name": name, "latest": {"ts": history[-1]["ts"]}}
+                             for channel_id, (name, history) in self.channels.items()]}
+
+    _conversations_list = _channels_list
+
+    def _conversations_history(self, channel, oldest=None, latest=None, inclusive=False, limit=100, cursor=None,
+                               **kwargs):
+        oldest = float(oldest or 0)
+        latest = float(latest or time.time())
+        # Like Slack, history only carries thread roots and the replies broadcast to the channel
+        history = [message for message in self.channels[channel][1] if Workspace._in_history(message)]
+        if inclusive:
+            selected = [message for message in history if oldest <= float(message["ts"]) <= latest]
+        else:
+            selected = [message for message in history if oldest < float(message["ts"]) < latest]
+        messages, response = Workspace._page(selected[::-1], cursor, limit)
+        response["messages"] = [dict(message) for message in messages]
+        return response
+
+    @staticmethod
+    def _in_history(message):
+        return message.get("thread_ts", message["ts"]) == message["ts"] or message.get("subtype") == "thread_broadcast"
+
+    def _conversations_replies(self, channel, ts, limit=100, cursor=None, **kwargs):
+        thread = [message for message in self.channels[channel][1] if message.get("thread_ts") == ts]
+        messages, response = Workspace._page(thread, cursor, limit)
+        response["messages"] = [dict(message) for message in messages]
+        return response
+
+    def _conversations_info(self, channel, **kwargs):
+        name, history = self.channels[channel]
+        return {"channel": {"id": channel, "name": name, "latest": {"ts": history[-1]["ts"]}}}
+
+    def _users_list(self, limit=100, cursor=None, **kwargs):
+        members, response = Workspace._page(self.users, cursor, limit)
+        response["members"] = [self._member(user_id) for user_id in members]
+        return response
+
+    def _users_info(self, user, **kwargs):
+        return {"user": self._member(user)}
+
+    @staticmethod
+    def _member(user_id):
+        return {"id": user_id, "name": user_id.lower(), "real_name": "User " + user_id,
+                "profile": {"real_name": "User " + user_id, "display_name": user_id.lower()}}
+
+    def _chat_getPermalink(self, channel, message_ts, **kwargs):
+        return {"permalink": "https://synthetic.slack.com/archives/{}/p{}".format(channel, message_ts.replace(".", ""))}
+
+
+class Unlimited:
+    """
+    Stands in for the rate limiter, so the benchmark measures the pipeline rather than Slack's tiers
+    """
+
+    def acquire(self, method):
+        return 0
+
+    def defer(self, method, seconds):
+        pass
+
+
+class EchoHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Answers every request the way Slack answers auth.test, keeping the connection open when asked to
+    """
+
+    protocol_version = "HTTP/1.1"
+    # Otherwise the body waits on the client's delayed ack of the headers
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        body = json.dumps({"ok": True, "url": "https://synthetic.slack.com/"}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def time_transport(calls):
+    """
+    Returns the milliseconds per call without and with the shared session.  The server is local and plain HTTP,
+    so this is a floor: against Slack each new connection also pays for DNS, the round trips and TLS.
+    """
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), EchoHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = "http://127.0.0.1:{}/api/auth.test".format(server.server_address[1])
+    results = {}
+    try:
+        for name, post in (("new connection", requests.post), ("keep-alive", open_session().post)):
+            started = time.monotonic()
+            for _ in range(calls):
+                post(url, data={"token": "synthetic"}).json()
+            results[name] = (time.monotonic() - started) / calls * 1000
+    finally:
+        server.shutdown()
+        server.server_close()
+    return results
+
+
+def run_scenario(name, scenario, latency, seed):
+    settings = dict(DEFAULTS, **scenario)
+    options = weekly_digest.Options()
+    options.store_args(["--start", "2020-01-05", "--end", "2020-01-12"] + settings["args"])
+    workspace = Workspace(options.start_timestamp, options.end_timestamp, seed, latency=latency / 1000, **settings)
+
+    api = weekly_digest.ApiWrapper(options, limiter=Unlimited())
+    api.slack = workspace
+    with tempfile.TemporaryDirectory() as folder:
+        cwd = os.getcwd()
+        os.chdir(folder)
+        tracemalloc.start()
+        started = time.monotonic()
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                weekly_digest.create_digest(options, api)
+            elapsed = time.monotonic() - started
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+            os.chdir(cwd)
+    return {"seconds": elapsed, "peak_mb": peak / 2 ** 20, "calls": dict(sorted(workspace.calls.items()))}
+
+
+def report(results):
+    print("{:<12} {:>9} {:>9}  {}".format("scenario", "seconds", "peak MB", "API calls"))
+    for name, result in results.items():
+        calls = ", ".join("{}={}".format(method, count) for method, count in result["calls"].items())
+        print("{:<12} {:>9.2f} {:>9.1f}  {}".format(name, result["seconds"], result["peak_mb"], calls))
+
+
+def regressions(results, baseline, tolerance):
+    found = []
+    for name, result in results.items():
+        expected = baseline.get(name, {})
+        for method, count in result["calls"].items():
+            if count > expected.get("calls", {}).get(method, 0):
+                found.append("{}: {} made {} calls, baseline {}".format(name, method, count,
+                                                                        expected.get("calls", {}).get(method, 0)))
+        if "peak_mb" in expected and result["peak_mb"] > expected["peak_mb"] * (1 + tolerance):
+            found.append("{}: peak memory {:.1f} MB, baseline {:.1f} MB".format(name, result["peak_mb"],
+                                                                               expected["peak_mb"]))
+    return found
+
+
+def memory_bounds(results):
+    found = []
+    for name, result in results.items():
+        other = SCENARIOS[name].get("peak_under")
+        if other in results and result["peak_mb"] > results[other]["peak_mb"] * PEAK_UNDER:
+            found.append("{}: peak memory {:.1f} MB, not clearly under {}'s {:.1f} MB".format(
+                name, result["peak_mb"], other, results[other]["peak_mb"]))
+    return found
+
+
+if __name__ == '__main__':
+    options = Options()
+    options.store_args()
+
+    results = {}
+    for name in options.parsed_args.scenarios:
+        results[name] = run_scenario(name, SCENARIOS[name], options.parsed_args.latency, options.parsed_args.seed)
+    report(results)
+
+    transport = None
+    if options.parsed_args.transport:
+        transport = time_transport(options.parsed_args.transport)
+        print()
+        print("{:<16} {:>9}".format("transport", "ms/call"))
+        for name, milliseconds in transport.items():
+            print("{:<16} {:>9.2f}".format(name, milliseconds))
+
+    if options.parsed_args.json:
+        with open(options.parsed_args.json, 'w') as f:
+            json.dump(dict(results, transport=transport) if transport else results, f, indent=2)
+
+    problems = memory_bounds(results)
+    baseline_file = options.parsed_args.baseline
+    if options.parsed_args.update_baseline:
+        baseline = {}
+        if os.path.exists(baseline_file):
+            with open(baseline_file, 'r') as f:
+                baseline = json.load(f)
+        baseline.update({name: {"calls": result["calls"], "peak_mb": round(result["peak_mb"], 2)}
+                         for name, result in results.items()})
+        with open(baseline_file, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+            f.write("\n")
+    elif os.path.exists(baseline_file):
+        with open(baseline_file, 'r') as f:
+            problems += regressions(results, json.load(f), options.parsed_args.memory_tolerance)
+    if problems:
+        print()
+        print("*** Regressions ***")
+        for problem in problems:
+            print(problem)
+        sys.exit(1)
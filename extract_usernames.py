@@ -1,9 +1,13 @@
 #! /usr/bin/env python3
 
 import argparse
+import concurrent.futures
 from html.parser import HTMLParser
+import os
+from permissions import PermissionLedger
 import re
-import requests
+from slack_api import open_session
+import sys
 
 
 class Options(argparse.ArgumentParser):
@@ -12,21 +16,40 @@ class Options(argparse.ArgumentParser):
     """
 
     def __init__(self):
-        super().__init__(description='Extract a list of user names from a given post.')
+        super().__init__(description='Extract a list of user names from the given post(s).')
         self.parsed_args = None
-        self._blacklist = []
-
-        self.add_argument("post",
-                          help="The post to extract the names from")
+        self.posts = []
+        self._blacklist = PermissionLedger()
+
+        self.add_argument("post", nargs='*',
+                          help="The post(s) to extract the names from, as urls or local files")
+        self.add_argument("--post-list", metavar="FILE",
+                          help="Extract the names from the post(s) given in the file (one per line)")
+        self.add_argument("--workers", type=int, default=4, metavar="N",
+                          help="Read up to N posts at a time (default: %(default)s)")
         self.add_argument("--exclude", nargs='+', metavar="USER",
-                          help="Specifically exclude the given user(s)")
+                          help="Specifically exclude the given user(s), in any case")
         self.add_argument("--exclude-list", metavar="FILE",
-                          help="Specifically exclude the user(s) given in the file (one per line)")
+                          help="Specifically exclude the user(s) given in the file (one per line), such as the " +
+                               "evergreen permissions")
+        self.add_argument("--no-compression", action="store_true",
+                          help="Ask for an uncompressed page")
 #
     def store_args(self):
         self.parsed_args = self.parse_args()
+        self._compile_posts()
+        if not self.posts:
+            self.error("At least one post or file of posts is required.")
         self._compile_blacklist()
 
+    def _compile_posts(self):
+        self.posts.extend(self.parsed_args.post)
+        if self.parsed_args.post_list:
+            with open(self.parsed_args.post_list, 'r') as f:
+                for line in f:
+                    if line.strip():
+                        self.posts.append(line.strip())
+
     def _compile_blacklist(self):
         self._add_command_line_exclusions()
         self._exclude_channels_from_file()
@@ -34,13 +57,11 @@ class Options(argparse.ArgumentParser):
     def _add_command_line_exclusions(self):
         if self.parsed_args.exclude:
             for user in self.parsed_args.exclude:
-                self._blacklist.append(user)
+                self._blacklist.add(user)
 
     def _exclude_channels_from_file(self):
         if self.parsed_args.exclude_list:
-            with open(self.parsed_args.exclude_list, 'r') as f:
-                for line in f:
-                    self._blacklist.append(line.rstrip('\n') )
+            self._blacklist.load(self.parsed_args.exclude_list)
 
     def filter_users(self, users):
         filtered = []
@@ -52,29 +73,49 @@ class Options(argparse.ArgumentParser):
 
 
 class MyParser(HTMLParser):
-    def __init__(self, text):
+    """
+    Finds the usernames mentioned in a post.  Given the text, it is parsed straight away; otherwise feed it in
+    as many pieces as it arrives in, and close the parser at the end.
+    """
+
+    def __init__(self, text=None):
         super().__init__()
         self.extract = False
         self.extracted = []
         self.usernames = []
+        self._text = []
 
-        self.feed(text)
+        if text is not None:
+            self.feed(text)
+            self.close()
+
+    def close(self):
+        super().close()
+        self._end_text()
         self._extract_usernames()
 
     def handle_starttag(self, tag, attrs):
+        self._end_text()
         if tag == "ts-rocket":
             self.extract = True
 
     def handle_endtag(self, tag):
+        self._end_text()
         if tag == "ts-rocket":
             self.extract = False
 
     def handle_data(self, data):
+        # Text can arrive split across pieces, so hold on to it until the next tag
         if self.extract:
+            self._text.append(data)
+
+    def _end_text(self):
+        if self._text:
+            data = "".join(self._text)
+            self._text = []
             if not "editors are" in data:
                 self.extracted.append(data)
 
-
     def _extract_usernames(self):
         found = []
         matcher = re.compile("(@[a-zA-Z][a-zA-Z._]+( [A-Z][a-zA-Z.-]*)?)")
@@ -87,12 +128,57 @@ class MyParser(HTMLParser):
         self.usernames = sorted(unique, key=lambda s: s.casefold())
 
 
+def read_post(post, session, chunk_size=64 * 1024):
+    """
+    Returns the usernames in the given url or local file, parsing it as it streams in
+    """
+    parser = MyParser()
+    if os.path.exists(post):
+        with open(post, 'r') as f:
+            for chunk in iter(lambda: f.read(chunk_size), ''):
+                parser.feed(chunk)
+    else:
+        with session.get(post, stream=True) as response:
+            response.raise_for_status()
+            response.encoding = response.encoding or 'utf-8'
+            for chunk in response.iter_content(chunk_size, decode_unicode=True):
+                parser.feed(chunk)
+    parser.close()
+    return parser.usernames
+
+
+def merge_usernames(lists):
+    """
+    Merges the usernames found in each post, treating names that differ only in case as the same person
+    """
+    merged = {}
+    for usernames in lists:
+        for user in usernames:
+            merged.setdefault(user.casefold(), user)
+    return sorted(merged.values(), key=lambda s: s.casefold())
+
+
 if __name__ == '__main__':
     options = Options()
     options.store_args()
 
-    post = requests.get(options.parsed_args.post)
-
-    parser = MyParser(post.text)
-    for user in options.filter_users(parser.usernames):
+    workers = max(1, options.parsed_args.workers)
+    session = open_session(pool_size=workers, compress=not options.parsed_args.no_compression)
+    found = []
+    unreadable = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(read_post, post, session) for post in options.posts]
+        for post, future in zip(options.posts, futures):
+            try:
+                found.append(future.result())
+            except (OSError, ValueError) as error:
+                unreadable.append((post, error))
+
+    for user in options.filter_users(merge_usernames(found)):
         print(user)
+
+    if unreadable:
+        print("\n*** Unable to read the following posts ***", file=sys.stderr)
+        for post, error in unreadable:
+            print("{} ({})".format(post, error), file=sys.stderr)
+        sys.exit(1)
@@ -1,9 +1,18 @@
 #! /usr/bin/env python3
 
 import argparse
+import concurrent.futures
+import hashlib
+import json
+import random
+import requests
+from slack_api import ApiClient, ApiMetrics, UserDirectory, open_client, open_session, report_metrics
 from slackclient import SlackClient
 import os
+from permissions import PermissionLedger
+import threading
 import time
+import urllib3
 
 token = "garbage"
 try:
@@ -11,7 +20,7 @@ try:
 except:
     pass
 
-slack = SlackClient(token)
+api = ApiClient(SlackClient(token))
 
 default_message = """:robot_face:I am a bot, posting on behalf of {0}. Beep-boop:robot_face:
 
@@ -73,6 +82,39 @@ class Options(argparse.ArgumentParser):
                                "Must include either url/deadline OR a message file")
         self.add_argument("--dry", action="store_true",
                           help="Print the message and users, but don't actually send the messages")
+        self.add_argument("--permissions", default="evergreen_permissions.txt", metavar="FILE",
+                          help="Skip the users given in the file (one per line, optionally followed by a tab and "
+                               "their Slack id), who have given evergreen approval (default: %(default)s)")
+        self.add_argument("--journal", default=".notification_journal.jsonl", metavar="FILE",
+                          help="Record each user notified in the given file, and skip anyone it says already got "
+                               "the same message (default: %(default)s)")
+        self.add_argument("--workers", type=int, default=4, metavar="N",
+                          help="Send up to N messages at a time, within Slack's posting limit (default: %(default)s)")
+        self.add_argument("--retries", type=int, default=3, metavar="N",
+                          help="Retry a message up to N times when it failed before reaching Slack, backing off "
+                               "between tries.  Messages that may have been posted are reported, not resent "
+                               "(default: %(default)s)")
+        self.add_argument("--user-cache", default=".user_directory.json", metavar="FILE",
+                          help="Cache the workspace's users in the given file between runs (default: %(default)s)")
+        self.add_argument("--user-cache-hours", type=float, default=24, metavar="HOURS",
+                          help="Refetch the cached users once they are older than HOURS.  Names not in the cache "
+                               "are always looked for (default: %(default)s)")
+        self.add_argument("--pool-size", type=int, default=10, metavar="N",
+                          help="Keep up to N connections to Slack open between calls (default: %(default)s)")
+        self.add_argument("--no-compression", action="store_true",
+                          help="Ask for uncompressed responses, trading bandwidth for CPU")
+        self.add_argument("--record", metavar="DIR",
+                          help="Save every API request and response to the given folder for later replay")
+        self.add_argument("--replay", metavar="DIR",
+                          help="Serve every API request from a folder saved with --record, rather than from Slack")
+        self.add_argument("--replay-latency", type=float, default=0, metavar="MS",
+                          help="Wait MS milliseconds on each replayed request (default: %(default)s)")
+        self.add_argument("--replay-rate-limit", type=float, default=0, metavar="FRACTION",
+                          help="Rate limit the given fraction of replayed requests (default: %(default)s)")
+        self.add_argument("--stats", action="store_true",
+                          help="Print a summary of the API calls made by each method at the end of the run")
+        self.add_argument("--stats-json", metavar="FILE",
+                          help="Write the summary of API calls to the given file as JSON")
 
     def store_args(self):
         self.parsed_args = self.parse_args()
@@ -113,10 +155,7 @@ class OriginatingUser:
     """
 
     def __init__(self):
-        response = slack.api_call("users.profile.get")
-        if not response['ok']:
-            print(response)
-            raise RuntimeError
+        response = api.call("users.profile.get")
         profile = response['profile']
         self.username = "@" + profile['display_name_normalized']
         self.firstname = self.username
@@ -134,11 +173,59 @@ class User:
         self.name = name
 
 
+class Journal:
+    """
+    An append-only record of the users each message has been delivered to, so a rerun of the same
+    notification only sends to the rest
+    """
+
+    def __init__(self, filename, message):
+        self.filename = filename
+        self.message = hashlib.sha256(message.encode()).hexdigest()
+        self.delivered = set()
+        self._file = None
+        self._lock = threading.Lock()
+        if os.path.exists(filename):
+            with open(filename, 'r') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # Cut short by a crash; that send wasn't recorded
+                        continue
+                    if entry['message'] == self.message:
+                        self.delivered.add(entry['user'])
+
+    def add(self, user_id):
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.filename, 'a+')
+                # Don't run on from a line cut short by a crash
+                if self._file.tell():
+                    self._file.seek(self._file.tell() - 1)
+                    if self._file.read(1) != "\n":
+                        self._file.write("\n")
+            self._file.write(json.dumps({'message': self.message, 'user': user_id}) + "\n")
+            self._file.flush()
+            self.delivered.add(user_id)
+
+
+class UncertainDelivery(RuntimeError):
+    """
+    A message failed in a way that leaves it unknown whether Slack posted it
+    """
+
+
 class Message:
     """
     Handle formatting the message to be sent and sending it as appropriate
     """
 
+    # Errors Slack gives without having taken the message, so asking again can't post it twice
+    RETRYABLE_ERRORS = {'request_timeout'}
+    # Errors after which the message may or may not have been posted
+    UNCERTAIN_ERRORS = {'internal_error', 'fatal_error', 'service_unavailable'}
+
     def __init__(self, message_file, url, deadline, from_user):
         self._message = default_message.format(from_user.firstname, url, deadline)
         if message_file:
@@ -146,81 +233,141 @@ class Message:
                 self._message = f.read()
         pass
 
-    def send(self, from_user, users, dry=False):
+    @property
+    def text(self):
+        return self._message
+
+    def send(self, from_user, users, dry=False, journal=None, workers=1, retries=3):
+        """
+        Sends the message to each user not already in the journal, workers at a time.  Returns the users it
+        couldn't be delivered to, and those it may or may not have reached, each with the reason.
+        """
         if dry:
             print("-" * 80)
             print(self._message)
             print("-" * 80)
             print("")
 
+        pending = []
         for user in users:
-            if not dry:
-                print("Notifying @{}".format(user.name))
-                response = slack.api_call("chat.postMessage", channel=user.id, text=self._message,
-                                          as_user=from_user.username)
-                if not response['ok']:
-                    print(response)
-                    raise RuntimeError
+            if journal and user.id in journal.delivered:
+                print("Already notified @{}".format(user.name))
+            elif not dry:
+                pending.append(user)
             else:
                 print("Would have notified @{}".format(user.name))
 
-
-def FetchUserIds(users):
-    user_ids = []
-    next = ''
-    while True:
-        response = slack.api_call("users.list", limit=250, cursor=next)
-        if not response['ok']:
-            if 'error' in response and 'ratelimited' in response['error']:
-                print("pausing...")
-                time.sleep(3)
-                continue
-            else:
-                print(response)
-                raise RuntimeError
-
-        if 'members' in response:
-            for member in response['members']:
-                id = member['id']
-                name = ''
-                real_name = ''
-                if 'name' in member:
-                    name = member['name']
-                if 'real_name' in member:
-                    real_name = member['real_name']
-
-                if name in users:
-                    user_ids.append(User(id, name))
-                    users.remove(name)
-                elif real_name in users:
-                    user_ids.append(User(id, real_name))
-                    users.remove(real_name)
-
-        if not users:
-            return user_ids, users
-
-        if not 'response_metadata' in response:
-            return user_ids, users
-        elif not 'next_cursor' in response['response_metadata']:
-            return user_ids, users
-        next = response['response_metadata']['next_cursor']
-        if not next:
-            return user_ids, users
-
-
-if __name__ == '__main__':
-    options = Options()
-    options.store_args()
-
+        failed = []
+        uncertain = []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            futures = {executor.submit(self._post, from_user, user, journal, retries): user for user in pending}
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    future.result()
+                except UncertainDelivery as error:
+                    uncertain.append((futures[future], str(error)))
+                except RuntimeError as error:
+                    failed.append((futures[future], str(error)))
+        return failed, uncertain
+
+    def _post(self, from_user, user, journal, retries):
+        print("Notifying @{}".format(user.name))
+        tries = 0
+        while True:
+            try:
+                api.call("chat.postMessage", channel=user.id, text=self._message, as_user=from_user.username)
+                break
+            except RuntimeError as error:
+                if str(error) in Message.UNCERTAIN_ERRORS:
+                    raise UncertainDelivery(str(error))
+                if str(error) not in Message.RETRYABLE_ERRORS or tries >= retries:
+                    raise
+            except requests.exceptions.RequestException as error:
+                if not Message._never_sent(error):
+                    raise UncertainDelivery(str(error))
+                if tries >= retries:
+                    raise RuntimeError(str(error))
+            tries += 1
+            time.sleep(2 ** tries * (1 + random.random()) / 2)
+        if journal:
+            journal.add(user.id)
+
+    @staticmethod
+    def _never_sent(error):
+        """
+        Whether the request failed before a connection to Slack was made, so Slack can't have seen it
+        """
+        if isinstance(error, requests.exceptions.ConnectTimeout):
+            return True
+        reason = getattr(error.args[0], 'reason', None) if error.args else None
+        return isinstance(reason, urllib3.exceptions.NewConnectionError)
+
+
+def FetchUserIds(users, directory):
+    found, unidentified = directory.resolve(users)
+    user_ids = [User(found[name], name) for name in users if name in found]
+    return user_ids, unidentified
+
+
+def SkipEvergreen(users, ledger, directory):
+    pending = []
+    for user in users:
+        known = directory.get(user.id)
+        names = [known['name'], known['real_name']]
+        if ledger.approved(user.id, names):
+            print("Skipping @{}, who has evergreen approval".format(user.name))
+        else:
+            pending.append(user)
+    return pending
+
+
+def notify(options):
     from_user = OriginatingUser()
-    (user_ids, unidentified_users) = FetchUserIds(options.usernames)
+    ledger = PermissionLedger()
+    if options.parsed_args.permissions and os.path.exists(options.parsed_args.permissions):
+        ledger.load(options.parsed_args.permissions)
+    directory = UserDirectory(api, cache_file=options.parsed_args.user_cache,
+                              ttl=options.parsed_args.user_cache_hours * 60 * 60)
+    (user_ids, unidentified_users) = FetchUserIds(options.usernames, directory)
+    user_ids = SkipEvergreen(user_ids, ledger, directory)
 
     message = Message(message_file=options.parsed_args.message, url=options.parsed_args.url,
                       deadline=options.parsed_args.deadline, from_user=from_user)
-    message.send(from_user, user_ids, dry=options.parsed_args.dry)
+    journal = None
+    if options.parsed_args.journal:
+        journal = Journal(options.parsed_args.journal, message.text)
+    failed, uncertain = message.send(from_user, user_ids, dry=options.parsed_args.dry, journal=journal,
+                                     workers=options.parsed_args.workers, retries=options.parsed_args.retries)
+
+    if failed:
+        print()
+        print("*** Unable to notify the following users; rerun to try them again ***")
+        for user, error in sorted(failed, key=lambda failure: failure[0].name.casefold()):
+            print("@{} ({})".format(user.name, error))
+
+    if uncertain:
+        print()
+        print("*** These messages may have been delivered; check before notifying the following users again ***")
+        for user, error in sorted(uncertain, key=lambda failure: failure[0].name.casefold()):
+            print("@{} ({})".format(user.name, error))
 
     if unidentified_users:
         print()
         print("*** Unable to identify the following users ***")
         for user in unidentified_users:
             print("@{}".format(user))
+
+
+if __name__ == '__main__':
+    options = Options()
+    options.store_args()
+    api.slack = open_client(token, record=options.parsed_args.record, replay=options.parsed_args.replay,
+                            latency=options.parsed_args.replay_latency / 1000,
+                            rate_limit=options.parsed_args.replay_rate_limit,
+                            session=open_session(options.parsed_args.pool_size, not options.parsed_args.no_compression))
+    if options.parsed_args.stats or options.parsed_args.stats_json:
+        api.metrics = ApiMetrics()
+    try:
+        notify(options)
+    finally:
+        report_metrics(api.metrics, options.parsed_args.stats, options.parsed_args.stats_json)
@@ -0,0 +1,45 @@
+class PermissionLedger:
+    """
+    The users who have given evergreen permission, indexed by case-folded handle or real name, along with their
+    Slack ids where known.  The permissions file has one name per line, optionally followed by a tab and the
+    user's id.  Names needn't be unique, so a line with an id only approves the user with that id.
+    """
+
+    def __init__(self, filename=None):
+        # The ids given for each name, None standing for a line without one
+        self._names = {}
+        self._ids = set()
+        if filename:
+            self.load(filename)
+
+    @staticmethod
+    def key(name):
+        return name.strip().lstrip('@').casefold()
+
+    def load(self, filename):
+        with open(filename, 'r') as f:
+            for line in f:
+                name, _, user_id = line.rstrip('\n').partition('\t')
+                if name.strip():
+                    self.add(name, user_id.strip() or None)
+
+    def add(self, name, user_id=None):
+        key = PermissionLedger.key(name)
+        if user_id:
+            self._ids.add(user_id)
+        self._names.setdefault(key, set()).add(user_id)
+
+    def __contains__(self, name):
+        return PermissionLedger.key(name) in self._names
+
+    def __len__(self):
+        return len(self._names)
+
+    def approved(self, user_id=None, names=()):
+        """
+        Whether the user with the given id has given permission, or one going by any of the given names under
+        a line without an id
+        """
+        if user_id and user_id in self._ids:
+            return True
+        return any(name and None in self._names.get(PermissionLedger.key(name), ()) for name in names)
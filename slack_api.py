@@ -0,0 +1,494 @@
+import json
+import os
+import random
+import requests
+from slackclient import SlackClient
+from slackclient.slackrequest import SlackRequest
+import threading
+import time
+
+
+class RateLimiter:
+    """
+    Paces Slack API calls with a token bucket per method, sized to the method's rate limit tier.
+    """
+
+    # Requests per minute allowed by Slack's rate limit tiers
+    TIER_1 = 1
+    TIER_2 = 20
+    TIER_3 = 50
+    TIER_4 = 100
+
+    RATES = {
+        "auth.test": TIER_4,
+        "channels.history": TIER_3,
+        "channels.list": TIER_2,
+        "chat.getPermalink": TIER_4,
+        "chat.postMessage": 60,  # Special: roughly one per second
+        "conversations.history": TIER_3,
+        "conversations.info": TIER_3,
+        "conversations.list": TIER_2,
+        "conversations.replies": TIER_3,
+        "team.info": TIER_3,
+        "users.info": TIER_4,
+        "users.list": TIER_2,
+        "users.profile.get": TIER_4,
+    }
+
+    def __init__(self, rates=None, default_rate=TIER_3):
+        self._rates = dict(RateLimiter.RATES)
+        if rates:
+            self._rates.update(rates)
+        self._default_rate = default_rate
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def _bucket(self, method):
+        if method not in self._buckets:
+            self._buckets[method] = _Bucket(self._rates.get(method, self._default_rate))
+        return self._buckets[method]
+
+    def acquire(self, method):
+        """
+        Blocks until a call to the given method fits in its budget.  Returns the time spent waiting.
+        """
+        with self._lock:
+            delay = self._bucket(method).reserve(time.monotonic())
+        if delay > 0:
+            time.sleep(delay)
+        return delay
+
+    def defer(self, method, seconds):
+        """
+        Holds off any further calls to the given method for the given number of seconds, as when
+        the server asks us to retry later.
+        """
+        with self._lock:
+            self._bucket(method).defer(time.monotonic(), seconds)
+
+
+class _Bucket:
+    def __init__(self, per_minute):
+        self.interval = 60.0 / per_minute
+        self.capacity = max(1, per_minute // 6)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) / self.interval)
+            self.updated = now
+
+    def reserve(self, now):
+        # Tokens may go negative; each caller waits out the debt in front of it
+        self._refill(now)
+        self.tokens -= 1
+        if self.tokens >= 0:
+            return 0
+        return -self.tokens * self.interval
+
+    def defer(self, now, seconds):
+        self._refill(now)
+        self.tokens = min(self.tokens, 0) - seconds / self.interval
+
+
+class ApiMetrics:
+    """
+    Tallies the calls made to each Slack API method, for a report at the end of a run
+    """
+
+    def __init__(self):
+        self._methods = {}
+        self._lock = threading.Lock()
+
+    def _method(self, method):
+        if method not in self._methods:
+            self._methods[method] = {'latencies': [], 'bytes': 0, 'rate_limited': 0, 'slept': 0.0}
+        return self._methods[method]
+
+    def record(self, method, seconds, response):
+        size = ApiMetrics._size(response)
+        with self._lock:
+            tally = self._method(method)
+            tally['latencies'].append(seconds)
+            tally['bytes'] += size
+
+    def rate_limited(self, method):
+        with self._lock:
+            self._method(method)['rate_limited'] += 1
+
+    def slept(self, method, seconds):
+        if seconds > 0:
+            with self._lock:
+                self._method(method)['slept'] += seconds
+
+    @staticmethod
+    def _size(response):
+        headers = response.get('headers') or {}
+        for name, value in headers.items():
+            if name.lower() == 'content-length' and value.isdigit():
+                return int(value)
+        # Compressed responses don't say, so measure what we were handed
+        return len(json.dumps(response))
+
+    @staticmethod
+    def _percentile(ordered, fraction):
+        return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+    def summary(self):
+        summary = {}
+        with self._lock:
+            for method, tally in sorted(self._methods.items()):
+                ordered = sorted(tally['latencies']) or [0.0]
+                summary[method] = {
+                    'calls': len(tally['latencies']),
+                    'p50_ms': ApiMetrics._percentile(ordered, 0.5) * 1000,
+                    'p90_ms': ApiMetrics._percentile(ordered, 0.9) * 1000,
+                    'p99_ms': ApiMetrics._percentile(ordered, 0.99) * 1000,
+                    'max_ms': ordered[-1] * 1000,
+                    'bytes': tally['bytes'],
+                    'rate_limited': tally['rate_limited'],
+                    'slept_seconds': tally['slept'],
+                }
+        return summary
+
+    def report(self):
+        template = "{:<24} {:>7} {:>9} {:>9} {:>9} {:>9} {:>10} {:>8} {:>9}"
+        print(template.format("method", "calls", "p50 ms", "p90 ms", "p99 ms", "max ms", "KB", "limited", "slept s"))
+        for method, stats in self.summary().items():
+            print(template.format(method, stats['calls'], "{:.0f}".format(stats['p50_ms']),
+                                  "{:.0f}".format(stats['p90_ms']), "{:.0f}".format(stats['p99_ms']),
+                                  "{:.0f}".format(stats['max_ms']), "{:.1f}".format(stats['bytes'] / 1024),
+                                  stats['rate_limited'], "{:.1f}".format(stats['slept_seconds'])))
+
+    def write(self, filename):
+        with open(filename, 'w') as f:
+            json.dump(self.summary(), f, indent=2)
+
+
+class RecordingClient:
+    """
+    Passes calls through to Slack, saving each request and its response to a cassette in the given folder
+    """
+
+    def __init__(self, slack, folder):
+        self.slack = slack
+        os.makedirs(folder, exist_ok=True)
+        self._file = open(os.path.join(folder, "calls.jsonl"), 'w')
+        self._lock = threading.Lock()
+
+    def api_call(self, method, timeout=None, **kwargs):
+        response = self.slack.api_call(method, timeout=timeout, **kwargs)
+        line = json.dumps({'method': method, 'args': kwargs, 'response': response}, default=str)
+        with self._lock:
+            self._file.write(line + "\n")
+            self._file.flush()
+        return response
+
+
+class ReplayClient:
+    """
+    Serves calls from a cassette saved by RecordingClient, without talking to Slack.  Repeated requests get
+    their recorded responses in order, so recorded rate limiting plays back as it happened.  Latency and
+    extra rate limiting can be simulated on top.
+    """
+
+    def __init__(self, folder, latency=0, rate_limit=0, seed=0):
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self._random = random.Random(seed)
+        self._responses = {}
+        self._lock = threading.Lock()
+        with open(os.path.join(folder, "calls.jsonl"), 'r') as f:
+            for line in f:
+                call = json.loads(line)
+                key = ReplayClient._key(call['method'], call['args'])
+                self._responses.setdefault(key, []).append(call['response'])
+
+    @staticmethod
+    def _key(method, kwargs):
+        return method, json.dumps(kwargs, sort_keys=True, default=str)
+
+    def api_call(self, method, timeout=None, **kwargs):
+        if self.latency:
+            time.sleep(self.latency)
+        # Round trip the arguments, so they match what was written
+        key = ReplayClient._key(method, json.loads(json.dumps(kwargs, default=str)))
+        with self._lock:
+            if self.rate_limit and self._random.random() < self.rate_limit:
+                return {'ok': False, 'error': 'ratelimited', 'headers': {'Retry-After': '1'}}
+            responses = self._responses.get(key)
+            if not responses:
+                return {'ok': False, 'error': 'not_recorded', 'headers': {}}
+            if len(responses) > 1:
+                return responses.pop(0)
+            return responses[0]
+
+
+def open_session(pool_size=10, compress=True):
+    """
+    Returns a session that keeps up to pool_size connections per host alive between requests, so only the
+    first request to a host pays for the handshakes
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    if not compress:
+        session.headers['Accept-Encoding'] = 'identity'
+    return session
+
+
+class SessionRequest(SlackRequest):
+    """
+    Sends SlackClient's requests through a shared session rather than a new connection each time
+    """
+
+    def __init__(self, session, proxies=None):
+        super().__init__(proxies=proxies)
+        self.session = session
+
+    def do(self, token, request="?", post_data=None, domain="slack.com", timeout=None):
+        post_data = dict(post_data or {})
+        token = post_data.get('token', token)
+        headers = {'user-agent': self.get_user_agent(), 'Authorization': 'Bearer {}'.format(token)}
+        for name, value in post_data.items():
+            if isinstance(value, list) and name in ('channels', 'users', 'types'):
+                post_data[name] = ",".join(value)
+            elif isinstance(value, (list, dict)):
+                post_data[name] = json.dumps(value)
+        return self.session.post("https://{0}/api/{1}".format(domain, request), headers=headers, data=post_data,
+                                 timeout=timeout, proxies=self.proxies)
+
+
+def open_client(token, record=None, replay=None, latency=0, rate_limit=0, session=None):
+    """
+    Returns the client to make Slack calls with, recording them to or replaying them from a cassette as asked.
+    Given a session, calls to Slack go through it.
+    """
+    if replay:
+        return ReplayClient(replay, latency=latency, rate_limit=rate_limit)
+    slack = SlackClient(token)
+    if session:
+        slack.server.api_requester = SessionRequest(session, proxies=slack.server.proxies)
+    if record:
+        return RecordingClient(slack, record)
+    return slack
+
+
+def report_metrics(metrics, table=False, json_file=None):
+    if not metrics:
+        return
+    if table:
+        print()
+        metrics.report()
+    if json_file:
+        metrics.write(json_file)
+
+
+class ApiClient:
+    """
+    Makes Slack API calls through a shared rate limiter, retrying when rate limited
+    """
+
+    def __init__(self, slack, limiter=None, retries=10, debug=False, metrics=None):
+        self.slack = slack
+        self.limiter = limiter or RateLimiter()
+        self.retries = retries
+        self.debug = debug
+        self.metrics = metrics
+
+    def call(self, method, **kwargs):
+        tries = 0
+        while True:
+            waited = self.limiter.acquire(method)
+            started = time.monotonic()
+            response = self.slack.api_call(method, **kwargs)
+            if self.metrics:
+                self.metrics.slept(method, waited)
+                self.metrics.record(method, time.monotonic() - started, response)
+            if response['ok']:
+                return response
+            if 'error' not in response or 'ratelimited' not in response['error']:
+                if self.debug:
+                    print(response)
+                raise RuntimeError(response.get('error'))
+            if self.metrics:
+                self.metrics.rate_limited(method)
+            tries += 1
+            if tries > self.retries:
+                raise RuntimeError("Rate limited {} times in a row".format(tries))
+            delay = ApiClient._retry_after(response, tries)
+            if self.debug:
+                print("Rate limited on {}; sleeping for {}".format(method, delay))
+            self.limiter.defer(method, delay)
+
+    @staticmethod
+    def _retry_after(response, tries):
+        headers = response.get('headers') or {}
+        for name, value in headers.items():
+            if name.lower() == 'retry-after':
+                try:
+                    return float(value)
+                except ValueError:
+                    break
+        return tries
+
+
+class UserDirectory:
+    """
+    The workspace's users, loaded through users.list and cached on disk for later runs.  A stale cache is
+    listed again and brought up to date in place.  Names missing from a fresh cache are listed for from where
+    the last listing stopped.  Users can be found by id, or by their handle, real name or display name
+    regardless of case.
+    """
+
+    FIELDS = ('name', 'real_name', 'display_name')
+
+    def __init__(self, api, cache_file=None, ttl=24 * 60 * 60):
+        self.api = api
+        self.cache_file = cache_file
+        self.ttl = ttl
+        self._users = None
+        self._index = {field: {} for field in UserDirectory.FIELDS}
+        self._fetched = 0
+        self._cursor = ''
+        self._refreshed = False
+        self._lock = threading.Lock()
+
+    def _load(self):
+        with self._lock:
+            if self._users is None:
+                self._users = {}
+                if not self._read_cache():
+                    # Listed again from the top, so every user we have is brought up to date in place
+                    self._cursor = ''
+                    self._refresh()
+            return self._users
+
+    def _add(self, user_id, user):
+        previous = self._users.get(user_id)
+        if previous:
+            for field, index in self._index.items():
+                key = previous[field].casefold()
+                if index.get(key) == user_id:
+                    del index[key]
+        self._users[user_id] = user
+        for field, index in self._index.items():
+            key = user[field].casefold()
+            if key:
+                index.setdefault(key, user_id)
+
+    def _read_cache(self):
+        """
+        Loads whatever users are cached, returning whether the cache is still fresh
+        """
+        if not self.cache_file or not os.path.exists(self.cache_file):
+            return False
+        try:
+            with open(self.cache_file, 'r') as f:
+                cached = json.load(f)
+        except ValueError:
+            return False
+        self._fetched = cached.get('fetched', 0)
+        self._cursor = cached.get('cursor', '')
+        for user_id, user in cached['users'].items():
+            self._add(user_id, user)
+        return time.time() - self._fetched <= self.ttl
+
+    def _write_cache(self):
+        if not self.cache_file:
+            return
+        temporary = self.cache_file + ".tmp"
+        with open(temporary, 'w') as f:
+            json.dump({'fetched': self._fetched, 'cursor': self._cursor, 'users': self._users}, f)
+        os.replace(temporary, self.cache_file)
+
+    def _refresh(self, wanted=None):
+        """
+        Pages through users.list from where the last listing stopped, adding each member to what we already
+        have.  Given names wanted, stops as soon as they have all been found, going round to the first page once
+        if need be; otherwise lists to the end, updating the users it passes.  The cache only counts as fresh
+        after reaching the end, and where a listing stopped is saved for the next one to carry on from.
+        """
+        self._refreshed = True
+        wrapped = not self._cursor
+        try:
+            while True:
+                try:
+                    response = self.api.call("users.list", limit=200, cursor=self._cursor)
+                except RuntimeError as error:
+                    if str(error) != 'invalid_cursor' or not self._cursor:
+                        raise
+                    # A saved cursor can expire; start again from the top
+                    self._cursor = ''
+                    wrapped = True
+                    continue
+                for member in response.get('members', []):
+                    self._add(member['id'], UserDirectory._summarize(member))
+                self._cursor = response.get('response_metadata', {}).get('next_cursor') or ''
+                if not self._cursor:
+                    self._fetched = time.time()
+                if wanted and all(self._find(name) for name in wanted):
+                    break
+                if not self._cursor:
+                    if not wanted or wrapped or all(self._find(name) for name in wanted):
+                        break
+                    wrapped = True
+        finally:
+            self._write_cache()
+
+    @staticmethod
+    def _summarize(member):
+        profile = member.get('profile', {})
+        return {
+            'name': member.get('name', ''),
+            'real_name': member.get('real_name') or profile.get('real_name', ''),
+            'display_name': profile.get('display_name', ''),
+        }
+
+    def _find(self, name):
+        key = name.casefold()
+        for field in UserDirectory.FIELDS:
+            if key in self._index[field]:
+                return self._index[field][key]
+        return None
+
+    def get(self, user_id):
+        """
+        Returns the summary for the given user, asking users.info about anyone the listing missed.
+        """
+        if not user_id:
+            return None
+        users = self._load()
+        if user_id not in users:
+            response = self.api.call("users.info", user=user_id)
+            with self._lock:
+                self._add(user_id, UserDirectory._summarize(response['user']))
+        return users[user_id]
+
+    def name(self, user_id):
+        user = self.get(user_id)
+        if not user:
+            return ""
+        return user['display_name'] or user['real_name']
+
+    def resolve(self, names):
+        """
+        Returns the ids for the given handles, real names or display names, preferring a handle match, along
+        with the names no one goes by.  Names the cached directory doesn't know send us back to users.list,
+        once per run, until they have all turned up.
+        """
+        self._load()
+        with self._lock:
+            if not self._refreshed and not all(self._find(name) for name in names):
+                self._refresh(wanted=[name for name in names if not self._find(name)])
+            found = {}
+            unknown = []
+            for name in names:
+                user_id = self._find(name)
+                if user_id:
+                    found[name] = user_id
+                else:
+                    unknown.append(name)
+        return found, unknown
@@ -1,40 +1,45 @@
 #! /usr/bin/env python3
 
 import argparse
+import collections
+import concurrent.futures
 import datetime
-from slackclient import SlackClient
+import heapq
+import itertools
+import json
+from slack_api import ApiClient, ApiMetrics, UserDirectory, open_client, open_session, report_metrics
 import os
 import re
-import sys
+import sqlite3
 import textwrap
+import threading
 import time
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
-class ApiWrapper:
+
+class ApiWrapper(ApiClient):
     """
     Consolidates API calls, error handling
     """
 
-    def __init__(self, options):
+    def __init__(self, options, limiter=None):
+        metrics = None
+        if options.parsed_args.stats or options.parsed_args.stats_json:
+            metrics = ApiMetrics()
+        slack = open_client(os.environ.get('API_TOKEN', "garbage"), record=options.parsed_args.record,
+                            replay=options.parsed_args.replay, latency=options.parsed_args.replay_latency / 1000,
+                            rate_limit=options.parsed_args.replay_rate_limit,
+                            session=open_session(options.parsed_args.pool_size, not options.parsed_args.no_compression))
+        super().__init__(slack, limiter=limiter, debug=options.debug, metrics=metrics)
         self.options = options
-        self.slack = SlackClient(os.environ.get('API_TOKEN', "garbage"))
-
-    def call(self, *args, **kwargs):
-        tries = 0;
-        while tries < 3:
-            response = self.slack.api_call(*args, **kwargs)
-            if response['ok']:
-                return response
-            if 'error' not in response or 'ratelimited' not in response['error']:
-                if options.debug:
-                    print(response)
-                raise RuntimeError
-            else:
-                if options.debug:
-                    print("Rate limited; sleeping for {}".format(tries))
-                tries += 1
-                time.sleep(tries)
-        raise RuntimeError("Rate limited three times in a row")
+        self._workspace_url = None
+        self._lock = threading.Lock()
+        self.permalinks = {}
+        self.thread_roots = {}
 
     def get_channels(self):
         response = self.call("channels.list", exclude_archived=True, exclude_members=True)
@@ -42,20 +47,59 @@ class ApiWrapper:
         for channel in response["channels"]:
             name = channel['name']
             channel_id = channel['id']
-            channels.append(Channel(api=self, channel_id=channel_id, name=name))
+            channels.append(Channel(api=self, channel_id=channel_id, name=name,
+                                    latest=ApiWrapper.latest_ts(channel)))
         return channels
 
-    def getPermalink(self, channel, message_ts):
-        response = self.call("chat.getPermalink", channel=channel, message_ts=message_ts)
-        return response['permalink']
+    def channelLatest(self, channel):
+        return ApiWrapper.latest_ts(self.call("conversations.info", channel=channel)['channel'])
 
-    def userProfile(self, user):
-        response = self.call("users.info", user=user)
-        return response['user']['profile']
+    @staticmethod
+    def latest_ts(channel):
+        # The last message, when the listing includes it; a channel without one has never been posted to
+        if 'latest' not in channel:
+            return None
+        latest = channel['latest']
+        if isinstance(latest, dict):
+            latest = latest.get('ts')
+        return float(latest or 0)
 
-    def channelHistory(self, channel, oldest=None, latest=None, inclusive=False, count=500):
-        return self.call("channels.history", channel=channel, inclusive=inclusive, oldest=oldest,
-                         latest=latest, count=count)
+    @property
+    def workspace_url(self):
+        with self._lock:
+            if not self._workspace_url:
+                self._workspace_url = self.call("auth.test")['url']
+            return self._workspace_url
+
+    def getPermalink(self, channel, message_ts, thread_ts=None):
+        # Thread replies need the thread and channel in the link, so leave those to Slack
+        if self.options.parsed_args.local_permalinks and not thread_ts:
+            return "{0}archives/{1}/p{2}".format(self.workspace_url, channel, message_ts.replace('.', ''))
+        key = (channel, message_ts)
+        if key not in self.permalinks:
+            response = self.call("chat.getPermalink", channel=channel, message_ts=message_ts)
+            self.permalinks[key] = response['permalink']
+        return self.permalinks[key]
+
+    def channelHistory(self, channel, oldest=None, latest=None, inclusive=False, limit=1000, cursor=None):
+        return self.call("conversations.history", channel=channel, inclusive=inclusive, oldest=oldest,
+                         latest=latest, limit=limit, cursor=cursor)
+
+    def threadReplies(self, channel, ts, limit=1000):
+        replies = []
+        cursor = None
+        while True:
+            response = self.call("conversations.replies", channel=channel, ts=ts, limit=limit, cursor=cursor)
+            replies.extend(message for message in response['messages'] if message['ts'] != ts)
+            cursor = ApiWrapper.next_cursor(response)
+            if not cursor:
+                return replies
+
+    @staticmethod
+    def next_cursor(response):
+        if not response.get('has_more'):
+            return None
+        return response.get('response_metadata', {}).get('next_cursor') or None
 
 
 def valid_date(s):
@@ -66,6 +110,27 @@ def valid_date(s):
         raise argparse.ArgumentTypeError(msg)
 
 
+def week_range(s):
+    try:
+        first, _, last = s.partition("..")
+        first = int(first)
+        last = int(last or first)
+    except ValueError:
+        msg = "Not a valid range of weeks: '{0}'.".format(s)
+        raise argparse.ArgumentTypeError(msg)
+    return range(min(first, last), max(first, last) + 1)
+
+
+def threshold_grid(s):
+    if ".." in s:
+        return list(week_range(s))
+    try:
+        return sorted({int(value) for value in s.split(",")})
+    except ValueError:
+        msg = "Not a valid list of thresholds: '{0}'.".format(s)
+        raise argparse.ArgumentTypeError(msg)
+
+
 class Options(argparse.ArgumentParser):
     """
     Consolidates our argument handling.
@@ -78,12 +143,17 @@ class Options(argparse.ArgumentParser):
         self.end_date = datetime.date.today()
         self.start_timestamp = datetime.datetime.now()
         self.end_timestamp = datetime.datetime.now()
-        self._whitelist = []
-        self._blacklist = []
+        self.weeks = []
+        self._whitelist = ChannelMatcher()
+        self._blacklist = ChannelMatcher()
+        self._decisions = {}
         self.debug = False
 
         self.add_argument("--week", type=int, default=1, metavar="N",
                           help="Fetch messages from N weeks ago (default: %(default)s)")
+        self.add_argument("--weeks", type=week_range, metavar="N..M",
+                          help="Write a separate digest for each week from N to M weeks ago, fetching them all at " +
+                               "once.  Overrides week, start and end.")
         self.add_argument("--start", type=valid_date, metavar="YYYY-MM-DD",
                           help="Fetch messages from the given date.  Overrides week start.")
         self.add_argument("--end", type=valid_date, metavar="YYYY-MM-DD",
@@ -100,6 +170,20 @@ class Options(argparse.ArgumentParser):
         self.add_argument("--thread-reactions", type=int, metavar="THRESHOLD", dest='thread_reply_threshold',
                           help="The number of in-thread reactions necessary for retaining a thread in the digest " +
                                "(default: twice the reactions threshold)")
+        self.add_argument("--fetch-replies-from", type=int, metavar="REPLIES",
+                          help="Only fetch the replies of threads with at least REPLIES replies, or whose first " +
+                               "message makes the reactions threshold.  Threads that make the replies threshold " +
+                               "are always fetched.  The rest are left out without counting their reactions, " +
+                               "which can miss short threads with many reactions, and the replies Slack reports " +
+                               "for them, bots' included, go towards the total messages (default: half the " +
+                               "replies threshold)")
+        self.add_argument("--fetch-all-replies", action='store_true', dest='fetch_all_replies',
+                          help="Fetch the replies of every thread, counting each thread's reactions exactly.  " +
+                               "Overrides fetch-replies-from.")
+        self.add_argument("--thread-lookback", type=float, default=7, metavar="DAYS",
+                          help="Count the replies within the window to threads started up to DAYS before it.  " +
+                               "Older threads are only found through replies also sent to the channel " +
+                               "(default: %(default)s)")
         self.add_argument("--exclude", nargs='+', metavar="CHANNEL",
                           help="Specifically exclude the given channel(s) (regular expressions allowed)")
         self.add_argument("--exclude-list", metavar="FILE",
@@ -107,15 +191,111 @@ class Options(argparse.ArgumentParser):
         self.add_argument("--split-by-channels", action='store_true', dest='split_by_channels',
                           help="Split the results by channel rather than consolidating messages and threads.  " +
                                "Default false.")
+        self.add_argument("--format", choices=['text', 'jsonl'], default='text',
+                          help="Write wrapped text files, or stream one JSON record per message and thread to " +
+                               "digest.jsonl as each channel is done (default: %(default)s)")
+        self.add_argument("--user-cache", default=".user_directory.json", metavar="FILE",
+                          help="Cache the workspace's users in the given file between runs (default: %(default)s)")
+        self.add_argument("--user-cache-hours", type=float, default=24, metavar="HOURS",
+                          help="Refetch the cached users once they are older than HOURS (default: %(default)s)")
+        self.add_argument("--skip-inactive", action='store_true', dest='skip_inactive',
+                          help="Skip channels whose last message came before the start, judging from the channel " +
+                               "listing, conversations.info or the activity cache.  Default false.")
+        self.add_argument("--activity-cache", default=".channel_activity.json", metavar="FILE",
+                          help="Remember when each channel was last posted to in the given file between runs " +
+                               "(default: %(default)s)")
+        self.add_argument("--top", type=int, metavar="N",
+                          help="Only annotate and write the N most reacted-to messages and threads.  " +
+                               "Ignored when splitting by channels or with --format jsonl, which write each " +
+                               "channel as it is fetched.")
+        self.add_argument("--local-permalinks", action='store_true', dest='local_permalinks',
+                          help="Build message links from the workspace url rather than asking Slack for each one.  " +
+                               "Thread replies are still looked up.  Default false.")
+        self.add_argument("--store", metavar="FILE",
+                          help="Keep fetched messages in the given SQLite file, so later runs only fetch what " +
+                               "they haven't already seen")
+        self.add_argument("--refresh-hours", type=float, default=48, metavar="HOURS",
+                          help="Refetch stored messages newer than HOURS, as they may still be gaining " +
+                               "reactions (default: %(default)s)")
+        self.add_argument("--checkpoint", default=".digest_checkpoint.jsonl", metavar="FILE",
+                          help="Save progress to the given file after each channel.  A run won't start while an " +
+                               "interrupted run's checkpoint is there unless told to resume or restart " +
+                               "(default: %(default)s)")
+        self.add_argument("--resume", action='store_true', dest='resume',
+                          help="Continue an interrupted run from its checkpoint rather than starting over.")
+        self.add_argument("--restart", action='store_true', dest='restart',
+                          help="Start over, discarding an interrupted run's checkpoint.")
+        self.add_argument("--streaming", action='store_true', dest='streaming',
+                          help="Only keep the messages that could make the digest while fetching, bounding memory " +
+                               "use on large channels.  Default false.")
+        self.add_argument("--workers", type=int, default=1, metavar="N",
+                          help="Fetch the history of up to N channels, and look up authors and links N at a time " +
+                               "(default: %(default)s)")
+        self.add_argument("--pool-size", type=int, default=10, metavar="N",
+                          help="Keep up to N connections to Slack open between calls (default: %(default)s)")
+        self.add_argument("--no-compression", action='store_true', dest='no_compression',
+                          help="Ask for uncompressed responses, trading bandwidth for CPU.  Default false.")
+        self.add_argument("--snapshot", metavar="FILE",
+                          help="Save the reaction and reply counts of every message fetched to the given NumPy " +
+                               "file, for later use with --sweep.  Not with --streaming or --resume.")
+        self.add_argument("--sweep", metavar="FILE",
+                          help="Rather than writing a digest, count how many messages and threads in a snapshot " +
+                               "pass each combination of the thresholds given by the grid options.  Makes no API " +
+                               "calls.")
+        self.add_argument("--reactions-grid", type=threshold_grid, metavar="N..M",
+                          help="The reactions thresholds to sweep, as a range or a comma separated list " +
+                               "(default: just the reactions threshold)")
+        self.add_argument("--replies-grid", type=threshold_grid, metavar="N..M",
+                          help="The replies thresholds to sweep (default: just the replies threshold)")
+        self.add_argument("--thread-reactions-grid", type=threshold_grid, metavar="N..M",
+                          help="The in-thread reactions thresholds to sweep (default: just the in-thread " +
+                               "reactions threshold)")
+        self.add_argument("--stats", action='store_true', dest='stats',
+                          help="Print a summary of the API calls made by each method at the end of the run.")
+        self.add_argument("--stats-json", metavar="FILE",
+                          help="Write the summary of API calls to the given file as JSON")
+        self.add_argument("--record", metavar="DIR",
+                          help="Save every API request and response to the given folder for later replay")
+        self.add_argument("--replay", metavar="DIR",
+                          help="Serve every API request from a folder saved with --record, rather than from Slack")
+        self.add_argument("--replay-latency", type=float, default=0, metavar="MS",
+                          help="Wait MS milliseconds on each replayed request (default: %(default)s)")
+        self.add_argument("--replay-rate-limit", type=float, default=0, metavar="FRACTION",
+                          help="Rate limit the given fraction of replayed requests (default: %(default)s)")
         self.add_argument("-d", "--debug", action='store_true', dest='debug',
                           help="Enable more thorough debugging messages.")
 
-    def store_args(self):
-        self.parsed_args = self.parse_args()
+    def store_args(self, args=None):
+        self.parsed_args = self.parse_args(args)
+        if (self.parsed_args.snapshot or self.parsed_args.sweep) and numpy is None:
+            self.error("--snapshot and --sweep need NumPy (pip install numpy)")
+        if self.parsed_args.snapshot and (self.parsed_args.streaming or self.parsed_args.resume):
+            self.error("--snapshot needs every message, so can't be used with --streaming or --resume")
+        if self.parsed_args.resume and self.parsed_args.restart:
+            self.error("--resume and --restart can't be used together")
+        if not (self.parsed_args.sweep or self.parsed_args.resume or self.parsed_args.restart) and \
+                os.path.exists(self.parsed_args.checkpoint):
+            self.error("{} holds an interrupted run; pass --resume to continue it or --restart to start "
+                       "over".format(self.parsed_args.checkpoint))
         self._extract_dates()
         self._compile_lists()
         self.debug = self.parsed_args.debug
 
+    @property
+    def fetch_replies_from(self):
+        """
+        How many replies make a thread worth fetching, never more than it takes to make the digest
+        """
+        if self.parsed_args.fetch_all_replies:
+            return 1
+        if self.parsed_args.fetch_replies_from is None:
+            return max(1, (self.parsed_args.reply_threshold + 1) // 2)
+        return min(self.parsed_args.fetch_replies_from, self.parsed_args.reply_threshold)
+
+    @property
+    def thread_lookback(self):
+        return self.parsed_args.thread_lookback * 24 * 60 * 60
+
     @property
     def thread_reactions(self):
         if self.parsed_args.thread_reply_threshold:
@@ -134,17 +314,23 @@ class Options(argparse.ArgumentParser):
 
     def _extract_dates(self):
         # Work in dates to force the beginning of the day
-        if self.parsed_args.week:
-            self.start_date, self.end_date = Options._find_week(self.parsed_args.week)
+        if self.parsed_args.weeks:
+            self.weeks = sorted(Options._find_week(week) for week in self.parsed_args.weeks)
+            self.start_date = self.weeks[0][0]
+            self.end_date = self.weeks[-1][1]
+        else:
+            if self.parsed_args.week:
+                self.start_date, self.end_date = Options._find_week(self.parsed_args.week)
 
-        if self.parsed_args.start:
-            self.start_date = self.parsed_args.start
+            if self.parsed_args.start:
+                self.start_date = self.parsed_args.start
 
-        if self.parsed_args.end:
-            self.end_date = self.parsed_args.end
+            if self.parsed_args.end:
+                self.end_date = self.parsed_args.end
 
-        if self.start_date > self.end_date:
-            raise ValueError
+            if self.start_date > self.end_date:
+                raise ValueError
+            self.weeks = [(self.start_date, self.end_date)]
 
         self.start_timestamp = datetime.datetime.combine(self.start_date, datetime.time())
         self.end_timestamp = datetime.datetime.combine(self.end_date, datetime.time())
@@ -152,46 +338,112 @@ class Options(argparse.ArgumentParser):
         # Return datetimes to allow easy timestamp conversion
         return self.start_timestamp, self.end_timestamp
 
+    @property
+    def run_key(self):
+        """
+        What a checkpoint must match to be resumed by this run
+        """
+        return {"windows": [[start.timestamp(), end.timestamp()] for start, end in self.windows],
+                "reactions": self.parsed_args.reactions, "replies": self.parsed_args.reply_threshold,
+                "thread_reactions": self.thread_reactions, "fetch_replies_from": self.fetch_replies_from,
+                "thread_lookback": self.parsed_args.thread_lookback}
+
+    @property
+    def windows(self):
+        return [(datetime.datetime.combine(start, datetime.time()), datetime.datetime.combine(end, datetime.time()))
+                for start, end in self.weeks]
+
     def _compile_lists(self):
         self._add_command_line_channels()
         self._add_channels_from_file()
         self._add_command_line_exclusions()
         self._exclude_channels_from_file()
+        self._whitelist.compile()
+        self._blacklist.compile()
 
     def _add_command_line_channels(self):
         if self.parsed_args.channel:
             for chan in self.parsed_args.channel:
-                self._whitelist.append(re.compile(chan))
+                self._whitelist.add(chan)
 
     def _add_command_line_exclusions(self):
         if self.parsed_args.exclude:
             for chan in self.parsed_args.exclude:
-                self._blacklist.append(re.compile(chan))
+                self._blacklist.add(chan)
 
     def _add_channels_from_file(self):
         if self.parsed_args.channel_list:
             with open(self.parsed_args.channel_list, 'r') as f:
                 for line in f:
                     for chan in line.split():
-                        self._whitelist.append(re.compile(chan))
+                        self._whitelist.add(chan)
 
     def _exclude_channels_from_file(self):
         if self.parsed_args.exclude_list:
             with open(self.parsed_args.exclude_list, 'r') as f:
                 for line in f:
                     for chan in line.split():
-                        self._blacklist.append(re.compile(chan))
+                        self._blacklist.add(chan)
 
     def filter_channel(self, name):
-        if any(expression.match(name) for expression in self._whitelist):
+        if name not in self._decisions:
+            self._decisions[name] = self._filter_channel(name)
+        return self._decisions[name]
+
+    def _filter_channel(self, name):
+        if self._whitelist.match(name):
             return False
-        elif any(expression.match(name) for expression in self._blacklist):
+        elif self._blacklist.match(name):
             return True
         elif not (self._whitelist or 'zmeta' in name):
             return False
         return True
 
 
+class ChannelMatcher:
+    """
+    Matches channel names against a list of patterns, as re.match against each of them would.  Plain names
+    are checked as prefixes against a set, and the remaining patterns are combined into one expression.
+    """
+
+    _SPECIAL = set(".^$*+?{}[]\\|()")
+
+    def __init__(self):
+        self._literals = set()
+        self._patterns = []
+        self._expressions = []
+
+    def __bool__(self):
+        return bool(self._literals or self._patterns)
+
+    def add(self, pattern):
+        if ChannelMatcher._SPECIAL.isdisjoint(pattern):
+            self._literals.add(pattern)
+        else:
+            self._expressions.append(re.compile(pattern))
+            self._patterns.append(pattern)
+
+    def compile(self):
+        # Joining patterns renumbers their groups, which would break any backreferences, so only those without
+        # groups are combined
+        expressions = [re.compile(pattern) for pattern in self._patterns]
+        simple = [pattern for pattern, expression in zip(self._patterns, expressions) if not expression.groups]
+        if len(simple) < 2:
+            return
+        try:
+            combined = re.compile("|".join("(?:{})".format(pattern) for pattern in simple))
+        except re.error:
+            # Such as a pattern with global flags, which must come first in an expression
+            return
+        self._expressions = [combined] + [expression for expression in expressions if expression.groups]
+
+    def match(self, name):
+        for end in range(1, len(name) + 1):
+            if name[:end] in self._literals:
+                return True
+        return any(expression.match(name) for expression in self._expressions)
+
+
 class Message:
     """
     Deals with interpreting message information
@@ -202,12 +454,17 @@ class Message:
         self.channel_id = channel.id
         self.channel_name = channel.name
         self._json = json
-        self.replies = []
+        self.reply_count = 0
+        self.threaded_reaction_count = 0
         self.username = ""
         self.url = ""
         self._reaction_count = None
         self._time = None
 
+    @property
+    def json(self):
+        return self._json
+
     @property
     def timestamp(self):
         return self._json["ts"]
@@ -227,8 +484,8 @@ class Message:
         return self._json.get('text')
 
     @property
-    def is_thread(self):
-        return self.replies
+    def reply_metadata(self):
+        return self._json.get('reply_count', 0)
 
     @property
     def thread_root(self):
@@ -247,12 +504,9 @@ class Message:
                 self._reaction_count += int(reaction['count'])
         return self._reaction_count
 
-    @property
-    def threaded_reaction_count(self):
-        count = 0
-        for message in self.replies:
-            count += message.reaction_count
-        return count
+    def add_replies(self, count, reactions):
+        self.reply_count += count
+        self.threaded_reaction_count += reactions
 
     @property
     def time(self):
@@ -268,43 +522,9 @@ class Message:
     def __str__(self):
         return str(self._json)
 
-    def annotate(self, users):
-        self._annotate_user(users)
-        self._annotate_link()
-
-    def _annotate_user(self, users):
-        user = users.get(self.user_id, User(api=self.api, user_id=self.user_id))
-        if user:
-            self.username = user.name
-
-    def _annotate_link(self):
-        self.url = self.api.getPermalink(channel=self.channel_id, message_ts=self.timestamp)
-
-
-class User:
-    """
-    Tracks and aggregates information specific to a user.
-    """
-
-    def __init__(self, api, user_id):
-        self.api = api
-        self.id = user_id
-        self._real_name = ""
-        self._display_name = ""
-
-    def fetch_name(self):
-        if not self._real_name and not self._display_name:
-            profile = self.api.userProfile(user=self.id)
-            self._real_name = profile['real_name']
-            self._display_name = profile['display_name']
-
     @property
-    def name(self):
-        if not self._real_name and not self._display_name:
-            self.fetch_name()
-        if self._display_name:
-            return self._display_name
-        return self._real_name
+    def link_key(self):
+        return self.channel_id, self.timestamp, self.thread_root
 
 
 class Channel:
@@ -312,51 +532,434 @@ class Channel:
     Tracks and aggregates information specific to a channel.
     """
 
-    def __init__(self, api, channel_id, name):
+    def __init__(self, api, channel_id, name, latest=None):
         self.api = api
         self.id = channel_id
         self.name = name
+        self.latest = latest
         self.all_messages = {}
+        self.message_count = 0
 
     def reset(self):
         self.all_messages = {}
+        self.message_count = 0
+
+    def fetch_windows(self, windows, store=None, message_filter=None, thread_filter=None):
+        """
+        Fetches the span covering all the windows at once, returning a copy of the channel holding the messages
+        of each window.  History is read once, each message going to the windows it counts in as it arrives,
+        so a backfill holds no more of it than a single window would.
+        """
+        channels = [self]
+        if len(windows) > 1:
+            channels = [Channel(api=self.api, channel_id=self.id, name=self.name) for _ in windows]
+        self._fetch(channels, [(start.timestamp(), end.timestamp()) for start, end in windows], store,
+                    message_filter, thread_filter)
+        return channels
 
-    def fetch_messages(self, start, end):
-        more = True
-        start_from = start.timestamp()
-        end_at = end.timestamp()
-        replies = []
-        while more:
-            response = self.api.channelHistory(channel=self.id, oldest=start_from, latest=end_at)
-            more = response['has_more']
-            for message in self._extract_messages(response):
-                self.all_messages[message.timestamp] = message
-                if message.from_bot:
-                    continue
-                if message.thread_root:
-                    replies.append(message)
-                end_at = message.timestamp
-        for message in replies:
-            self._accumulate_thread(message)
-
-    def _extract_messages(self, response):
-        messages = []
-        message_list = response['messages']
-        for json_msg in message_list:
-            messages.append(Message(api = self.api, channel=self, json=json_msg))
-        return messages
-
-    def _accumulate_thread(self, message):
-        root = message.thread_root
-        if root not in self.all_messages:
-            self.all_messages[root] = self.fetch_message(root)
-        self.all_messages[root].replies.append(message)
+    def fetch_messages(self, start, end, store=None, message_filter=None, thread_filter=None):
+        """
+        Fetches the messages in the window.  Given a message filter, messages are decided on as they arrive and
+        only those that could make the digest are kept; otherwise every message is kept in all_messages.
+        Given a thread filter, only the threads it thinks worth it have their replies fetched; the rest are
+        judged on the number of replies their root reports.
+        """
+        self._fetch([self], [(start.timestamp(), end.timestamp())], store, message_filter, thread_filter)
+
+    def _fetch(self, channels, bounds, store, message_filter, thread_filter):
+        lookback = self.api.options.thread_lookback
+        # The roots of broadcast replies to threads started before a window's lookback, with those windows
+        strays = {}
+        for json_msg in self._history(bounds[0][0] - lookback, bounds[-1][1], store):
+            # Only kept while the windows go over this message, so each thread is fetched once for all of them
+            replies = {}
+            for index, (channel, (oldest, latest)) in enumerate(zip(channels, bounds)):
+                root = channel.add_message(json_msg, oldest, latest, message_filter, thread_filter, replies)
+                if root:
+                    strays.setdefault(root, set()).add(index)
+            # History is newest first, so any window wanting this root as a stray has already said so
+            for index in strays.pop(json_msg['ts'], ()):
+                channels[index]._add_old_thread(json_msg, *bounds[index], message_filter, thread_filter, replies)
+
+        # The rest started before the history we fetched
+        self._fetch_roots(strays)
+        for root, indexes in strays.items():
+            replies = {}
+            for index in indexes:
+                channels[index]._add_old_thread(self.api.thread_roots[(self.id, root)], *bounds[index],
+                                                message_filter, thread_filter, replies)
+
+    def add_message(self, json_msg, oldest, latest, message_filter=None, thread_filter=None, replies=None):
+        """
+        Adds a message from the history if it falls in the window, or if it started a thread that still had
+        replies in the window.  History only carries thread roots, and the replies broadcast to the channel;
+        the rest of each thread is fetched from its root.  Returns the root of a broadcast reply whose thread
+        started too long before the window to be in the history, for the caller to resolve.
+        """
+        message = Message(api=self.api, channel=self, json=json_msg)
+        when = float(message.timestamp)
+        lookback = self.api.options.thread_lookback
+        if oldest < when < latest:
+            self.message_count += 1
+            # A broadcast reply is counted along with the rest of its thread
+            if not message.thread_root:
+                self._add_thread(message, oldest, latest, thread_filter, replies)
+            self._retain(message, message_filter)
+            if message.thread_root and float(message.thread_root) <= oldest - lookback:
+                return message.thread_root
+        elif oldest - lookback < when <= oldest < float(json_msg.get('latest_reply', 0)):
+            self._add_old_thread(json_msg, oldest, latest, message_filter, thread_filter, replies)
+        return None
+
+    def _add_old_thread(self, json_msg, oldest, latest, message_filter, thread_filter, replies):
+        root = Message(api=self.api, channel=self, json=json_msg)
+        if self._add_thread(root, oldest, latest, thread_filter, replies, started_before=True):
+            self.message_count += 1
+            self._retain(root, message_filter)
+
+    def _add_thread(self, root, oldest, latest, thread_filter=None, replies=None, started_before=False):
+        """
+        Counts the replies to the given root and the reactions to them.  A thread started in the window counts
+        all its replies; one started before it only those within it.  Returns whether there were any.
+        """
+        count = root.reply_metadata
+        if not count:
+            return False
+        # Only the replies themselves tell how many of an older thread's fell within the window
+        if thread_filter and not started_before and not thread_filter.worth_fetching(root):
+            root.add_replies(count, 0)
+            self.message_count += count
+            return True
+        if replies is None:
+            replies = {}
+        if root.timestamp not in replies:
+            replies[root.timestamp] = self.api.threadReplies(channel=self.id, ts=root.timestamp)
+        thread = [Message(api=self.api, channel=self, json=json_msg) for json_msg in replies[root.timestamp]]
+        thread = [reply for reply in thread if not reply.from_bot and
+                  (not started_before or oldest < float(reply.timestamp) < latest)]
+        if not thread:
+            return False
+        root.add_replies(len(thread), sum(reply.reaction_count for reply in thread))
+        self.message_count += len(thread)
+        return True
+
+    def _fetch_roots(self, timestamps):
+        """
+        Resolves thread roots from before the history fetched by paging back once through the range they span,
+        rather than fetching each one separately.  Roots are cached on the api for the rest of the run.
+        """
+        cache = self.api.thread_roots
+        missing = sorted({ts for ts in timestamps if (self.id, ts) not in cache}, key=float)
+        oldest = missing[0] if missing else None
+        latest = missing[-1] if missing else None
+        cursor = None
+        pages = 0
+        # Stop paging once it has cost as many calls as fetching the remaining roots one by one would
+        while len(missing) > 1 and pages < len(missing):
+            response = self.api.channelHistory(channel=self.id, oldest=oldest, latest=latest, inclusive=True,
+                                               cursor=cursor)
+            pages += 1
+            wanted = set(missing)
+            for json_msg in response['messages']:
+                if json_msg['ts'] in wanted:
+                    cache[(self.id, json_msg['ts'])] = json_msg
+            missing = [ts for ts in missing if (self.id, ts) not in cache]
+            cursor = ApiWrapper.next_cursor(response)
+            if not cursor:
+                break
+        for timestamp in missing:
+            self.fetch_message(timestamp)
 
     def fetch_message(self, timestamp):
-        if timestamp in self.all_messages:
-            return self.all_messages[timestamp]
-        response = self.api.channelHistory(channel=self.id, inclusive=True, latest=timestamp, count=1)
-        return self._extract_messages(response)[0]
+        key = (self.id, timestamp)
+        if key not in self.api.thread_roots:
+            response = self.api.channelHistory(channel=self.id, inclusive=True, latest=timestamp, limit=1)
+            self.api.thread_roots[key] = response['messages'][0]
+        return Message(api=self.api, channel=self, json=self.api.thread_roots[key])
+
+    def _retain(self, message, message_filter, timestamp=None):
+        if message_filter and not message_filter.retains(message):
+            return
+        self.all_messages[timestamp or message.timestamp] = message
+
+    def _history(self, oldest, latest, store):
+        """
+        Yields the json for each message in the window, newest first
+        """
+        if not store:
+            for page in self._fetch_pages(oldest, latest):
+                yield from page
+            return
+        for gap_oldest, gap_latest in store.gaps(self.id, oldest, latest):
+            for page in self._fetch_pages(gap_oldest, gap_latest):
+                store.add(self.id, page)
+            store.cover(self.id, gap_oldest, gap_latest)
+        yield from store.messages(self.id, oldest, latest)
+
+    def _fetch_pages(self, oldest, latest):
+        """
+        Yields each page of history in the range, requesting the next page before handing back the current one
+        """
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as prefetcher:
+            pending = prefetcher.submit(self.api.channelHistory, channel=self.id, oldest=oldest, latest=latest)
+            while pending:
+                response = pending.result()
+                cursor = ApiWrapper.next_cursor(response)
+                pending = None
+                if cursor:
+                    pending = prefetcher.submit(self.api.channelHistory, channel=self.id, oldest=oldest,
+                                                latest=latest, cursor=cursor)
+                yield response['messages']
+
+
+class MessageStore:
+    """
+    Keeps fetched messages in a local SQLite database, so later runs only fetch the parts of their window
+    not already covered.  Messages newer than the refresh horizon may still gain reactions and replies, so
+    they are not counted as covered and get fetched again next time.
+    """
+
+    def __init__(self, filename, refresh_horizon):
+        self.refresh_horizon = refresh_horizon
+        self._db = sqlite3.connect(filename, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._db:
+            self._db.execute("CREATE TABLE IF NOT EXISTS messages "
+                             "(channel TEXT, ts TEXT, time REAL, json TEXT, PRIMARY KEY (channel, ts))")
+            self._db.execute("CREATE TABLE IF NOT EXISTS coverage (channel TEXT, oldest REAL, latest REAL)")
+
+    def gaps(self, channel_id, oldest, latest):
+        with self._lock:
+            covered = self._db.execute("SELECT oldest, latest FROM coverage WHERE channel = ? AND latest > ? "
+                                       "AND oldest < ? ORDER BY oldest", (channel_id, oldest, latest)).fetchall()
+        gaps = []
+        position = oldest
+        for covered_oldest, covered_latest in covered:
+            if covered_oldest > position:
+                gaps.append((position, covered_oldest))
+            position = max(position, covered_latest)
+        if position < latest:
+            gaps.append((position, latest))
+        return gaps
+
+    def add(self, channel_id, json_messages):
+        with self._lock, self._db:
+            self._db.executemany("INSERT OR REPLACE INTO messages VALUES (?, ?, ?, ?)",
+                                 [(channel_id, json_msg['ts'], float(json_msg['ts']), json.dumps(json_msg))
+                                  for json_msg in json_messages])
+
+    def cover(self, channel_id, oldest, latest):
+        settled = min(latest, time.time() - self.refresh_horizon)
+        if settled > oldest:
+            with self._lock, self._db:
+                self._db.execute("INSERT INTO coverage VALUES (?, ?, ?)", (channel_id, oldest, settled))
+
+    def messages(self, channel_id, oldest, latest, batch=500):
+        with self._lock:
+            cursor = self._db.execute("SELECT json FROM messages WHERE channel = ? AND time > ? AND time < ? "
+                                      "ORDER BY time DESC", (channel_id, oldest, latest))
+            rows = cursor.fetchmany(batch)
+        while rows:
+            for row in rows:
+                yield json.loads(row[0])
+            with self._lock:
+                rows = cursor.fetchmany(batch)
+
+
+class ChannelActivity:
+    """
+    When each channel last saw a message, so channels quiet throughout the window can be skipped before fetching
+    their history.  What Slack tells us is cached along with when we asked, which settles any window that had
+    already ended by then without asking again.
+    """
+
+    def __init__(self, api, filename=None):
+        self.api = api
+        self.filename = filename
+        self._seen = {}
+        self._lock = threading.Lock()
+        if filename and os.path.exists(filename):
+            try:
+                with open(filename, 'r') as f:
+                    self._seen = json.load(f)
+            except ValueError:
+                self._seen = {}
+
+    def _latest(self, channel, end):
+        if channel.latest is not None:
+            latest = channel.latest
+        else:
+            with self._lock:
+                cached = self._seen.get(channel.id)
+            if cached and cached[1] >= end:
+                return cached[0]
+            latest = self.api.channelLatest(channel.id)
+            if latest is None:
+                return None
+        with self._lock:
+            self._seen[channel.id] = [latest, time.time()]
+        return latest
+
+    def active(self, channel, start, end):
+        latest = self._latest(channel, end)
+        return latest is None or latest >= start
+
+    def filter_channels(self, channels, start, end, workers=1):
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            active = list(executor.map(lambda channel: self.active(channel, start, end), channels))
+        self.save()
+        return [channel for channel, keep in zip(channels, active) if keep]
+
+    def save(self):
+        if not self.filename:
+            return
+        temporary = self.filename + ".tmp"
+        with open(temporary, 'w') as f:
+            json.dump(self._seen, f)
+        os.replace(temporary, self.filename)
+
+
+class Snapshot:
+    """
+    The counts the thresholds are judged on for every message fetched, kept as columns so a sweep over many
+    thresholds can be counted without fetching again
+    """
+
+    COLUMNS = ("ts", "window", "channel", "reactions", "replies", "thread_reactions")
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._channels = {}
+        self._columns = {name: [] for name in Snapshot.COLUMNS}
+
+    def add_channel(self, channel, window=0):
+        index = self._channels.setdefault(channel.name, len(self._channels))
+        for message in channel.all_messages.values():
+            self._columns["ts"].append(float(message.timestamp))
+            self._columns["window"].append(window)
+            self._columns["channel"].append(index)
+            self._columns["reactions"].append(message.reaction_count)
+            self._columns["replies"].append(message.reply_count)
+            self._columns["thread_reactions"].append(message.threaded_reaction_count)
+
+    def save(self):
+        columns = {name: numpy.asarray(values, dtype=numpy.float64 if name == "ts" else numpy.int32)
+                   for name, values in self._columns.items()}
+        # savez appends .npz to any other name, so write through a file object to keep the name we were given
+        with open(self.filename, 'wb') as f:
+            numpy.savez_compressed(f, channels=numpy.asarray(list(self._channels), dtype=str), **columns)
+
+
+def sweep(filename, reactions_grid, replies_grid, thread_reactions_grid):
+    """
+    Returns (reactions, replies, thread reactions, messages, threads) for each combination of the thresholds,
+    counting what a digest of the snapshot would keep with them
+    """
+    with numpy.load(filename) as snapshot:
+        reactions = numpy.sort(snapshot["reactions"])
+        replies = snapshot["replies"]
+        thread_reactions = snapshot["thread_reactions"]
+
+    # A message is kept when its reactions reach the threshold
+    messages = len(reactions) - numpy.searchsorted(reactions, reactions_grid, side='left')
+    rows = []
+    for reply_threshold in replies_grid:
+        # A thread is kept on its replies, or failing that on the reactions in it
+        long_threads = replies >= reply_threshold
+        others = numpy.sort(thread_reactions[~long_threads])
+        threads = numpy.count_nonzero(long_threads) + len(others) - numpy.searchsorted(others, thread_reactions_grid,
+                                                                                       side='left')
+        for reaction_threshold, message_count in zip(reactions_grid, messages):
+            for thread_threshold, thread_count in zip(thread_reactions_grid, threads):
+                rows.append((reaction_threshold, reply_threshold, thread_threshold, int(message_count),
+                             int(thread_count)))
+    return rows
+
+
+def print_sweep(options):
+    rows = sweep(options.parsed_args.sweep,
+                 options.parsed_args.reactions_grid or [options.parsed_args.reactions],
+                 options.parsed_args.replies_grid or [options.parsed_args.reply_threshold],
+                 options.parsed_args.thread_reactions_grid or [options.thread_reactions])
+    template = "{:>9} {:>9} {:>16} {:>9} {:>9}"
+    print(template.format("reactions", "replies", "thread-reactions", "messages", "threads"))
+    for row in rows:
+        print(template.format(*row))
+
+
+class Checkpoint:
+    """
+    Records the retained messages of each channel as it completes, so an interrupted run can resume after the
+    last finished channel.  Kept as JSON lines: the run it belongs to, then one line per finished channel
+    along with any permalinks looked up since the previous line.
+    """
+
+    def __init__(self, filename, run):
+        self.filename = filename
+        self.run = run
+        self._file = None
+        self._saved_links = 0
+
+    def start(self):
+        self._file = open(self.filename, 'w')
+        self._write({"run": self.run})
+
+    def resume(self, api, channels):
+        """
+        Returns the finished channels, each as its list of per-window channels, and carries on the file
+        """
+        by_id = {channel.id: channel for channel in channels}
+        finished = []
+        with open(self.filename, 'r') as f:
+            lines = [json.loads(line) for line in f if line.endswith("\n")]
+        if not lines or lines[0].get("run") != self.run:
+            raise RuntimeError("{} was saved by a different run".format(self.filename))
+        for line in lines[1:]:
+            for channel_id, timestamp, url in line.get("permalinks", []):
+                api.permalinks[(channel_id, timestamp)] = url
+            if "channel" in line and line["channel"] in by_id:
+                finished.append([Checkpoint._restore(api, by_id[line["channel"]], window)
+                                 for window in line["windows"]])
+        self._saved_links = len(api.permalinks)
+        self._file = open(self.filename, 'a')
+        return finished
+
+    @staticmethod
+    def _restore(api, original, window):
+        channel = Channel(api=api, channel_id=original.id, name=original.name)
+        channel.message_count = window["message_count"]
+        for key, json_msg, replies, reactions in window["messages"]:
+            message = Message(api=api, channel=channel, json=json_msg)
+            message.add_replies(replies, reactions)
+            channel.all_messages[key] = message
+        return channel
+
+    def add(self, windows, message_filter, api):
+        line = self._links(api)
+        line["channel"] = windows[0].id
+        line["windows"] = [{"message_count": channel.message_count,
+                            "messages": [[key, message.json, message.reply_count, message.threaded_reaction_count]
+                                         for key, message in channel.all_messages.items()
+                                         if message_filter.retains(message)]}
+                           for channel in windows]
+        self._write(line)
+
+    def save_links(self, api):
+        if self._file and len(api.permalinks) > self._saved_links:
+            self._write(self._links(api))
+
+    def _links(self, api):
+        links = list(api.permalinks.items())[self._saved_links:]
+        self._saved_links += len(links)
+        return {"permalinks": [[channel_id, timestamp, url] for (channel_id, timestamp), url in links]}
+
+    def _write(self, line):
+        self._file.write(json.dumps(line) + "\n")
+        self._file.flush()
+
+    def finish(self):
+        self._file.close()
+        os.remove(self.filename)
 
 
 class MessageSorter:
@@ -391,19 +994,34 @@ class Filter:
                 filtered.append(channel)
         return filtered
 
+    def keep_message(self, message):
+        return message.reaction_count >= self._options.parsed_args.reactions
+
+    def keep_thread(self, message):
+        if message.reply_count >= self._options.parsed_args.reply_threshold:
+            return True
+        return message.threaded_reaction_count >= self._options.thread_reactions
+
+    def retains(self, message):
+        return self.keep_message(message) or self.keep_thread(message)
+
+    def worth_fetching(self, root):
+        # A thread's reactions are only known once it's fetched, so short threads are only worth it when their
+        # first message drew reactions too.  Those left out can't make the replies threshold, so counting bots'
+        # replies along with the rest can't change what is kept.
+        return root.reply_metadata >= self._options.fetch_replies_from or self.keep_message(root)
+
     def filter_messages(self, all_messages):
         filtered = []
         for message in all_messages:
-            if message.reaction_count >= self._options.parsed_args.reactions:
+            if self.keep_message(message):
                 filtered.append(message)
         return filtered
 
     def filter_threads(self, all_messages):
         filtered = []
         for message in all_messages:
-            if len(message.replies) >= self._options.parsed_args.reply_threshold:
-                filtered.append(message)
-            elif message.threaded_reaction_count >= self._options.thread_reactions:
+            if self.keep_thread(message):
                 filtered.append(message)
         return filtered
 
@@ -460,30 +1078,52 @@ class ThreadFormatter:
 
     def format(self, message):
         return self._template.format(sep=self._sep, url=message.url, name=message.username, time=message.time,
-                                     text=self._wrapper.fill(message.text), replies=len(message.replies),
+                                     text=self._wrapper.fill(message.text), replies=message.reply_count,
                                      react=message.threaded_reaction_count, channel=message.channel_name)
 
 
+class RecordFormatter:
+    """
+    A class to repeatedly format messages and threads as single-line JSON records
+    """
+
+    def format(self, message, kind):
+        return json.dumps({
+            "kind": kind,
+            "channel": message.channel_name,
+            "channel_id": message.channel_id,
+            "ts": message.timestamp,
+            "time": message.time,
+            "user": message.username,
+            "user_id": message.user_id,
+            "url": message.url,
+            "reactions": message.reaction_count,
+            "replies": message.reply_count,
+            "thread_reactions": message.threaded_reaction_count,
+            "text": message.text,
+        }) + "\n"
+
+
 class Writer:
     """
     A base class for writing
     """
 
-    def __init__(self, message_filter, sorter, options):
+    def __init__(self, message_filter, sorter, options, users, folder_name=None):
         self._filter = message_filter
+        self._users = users
         self._sorter = sorter
         self.options = options
         self.total_messages = 0
         self.total_channels = 0
-        self.folder_name = Writer._create_folder()
+        self.folder_name = Writer._create_folder(folder_name or datetime.date.today().isoformat())
         self._wrapper = textwrap.TextWrapper(width=80, expand_tabs=False, replace_whitespace=False,
                                              drop_whitespace=False)
         self._channel_report_template = \
             "\t{name}: {messages} potential messages, {threads} long threads from {total} total messages"
 
     @staticmethod
-    def _create_folder():
-        name = datetime.date.today().isoformat()
+    def _create_folder(name):
         try:
             if not os.path.exists(name):
                 os.makedirs(name)
@@ -492,8 +1132,8 @@ class Writer:
             raise
         return name
 
-    def _filename(self, name):
-        return self.folder_name + "/" + name + ".txt"
+    def _filename(self, name, extension=".txt"):
+        return self.folder_name + "/" + name + extension
 
 
 class ChannelWriter(Writer):
@@ -501,32 +1141,31 @@ class ChannelWriter(Writer):
     Writes the message information to files by channel
     """
 
-    def __init__(self, message_filter, sorter, options):
-        super().__init__(message_filter, sorter, options)
+    def __init__(self, message_filter, sorter, options, users, folder_name=None):
+        super().__init__(message_filter, sorter, options, users, folder_name)
         self.filtered_messages = 0
         self.total_threads = 0
-        self._users = {}
         self._channel_formatter = ChannelFormatter()
         self._message_formatter = MessageFormatter(self._wrapper, add_channel_name=False)
         self._thread_formatter = ThreadFormatter(self._wrapper, add_channel_name=False)
 
     def add_channel(self, channel):
-        all_messages = channel.all_messages.values()
-        if not all_messages:
+        if not channel.message_count:
             return
 
-        self.total_messages += len(all_messages)
+        self.total_messages += channel.message_count
+
+        all_messages = channel.all_messages.values()
 
         messages = self._filter.filter_messages(all_messages)
         threads = self._filter.filter_threads(all_messages)
         if not (messages or threads):
             return
 
-        annotate_messages(messages, self._users)
-        annotate_messages(threads, self._users)
+        annotate_messages(messages + threads, self._users, workers=self.options.parsed_args.workers)
         if len(messages) or len(threads) or self.options.debug:
             print(self._channel_report_template.format(name=channel.name, messages=len(messages), threads=len(threads),
-                                                       total=len(channel.all_messages)))
+                                                       total=channel.message_count))
         self.filtered_messages += len(messages)
         self.total_threads += len(threads)
         self.total_channels += 1
@@ -560,30 +1199,50 @@ class ConsolidatedWriter(Writer):
     Writes the message information to files by messages and threads
     """
 
-    def __init__(self, message_filter, sorter, options):
-        super().__init__(message_filter, sorter, options)
+    def __init__(self, message_filter, sorter, options, users, folder_name=None):
+        super().__init__(message_filter, sorter, options, users, folder_name)
+        self.filtered_messages = 0
+        self.total_threads = 0
         self._messages = []
         self._threads = []
+        self._top = options.parsed_args.top
+        self._order = itertools.count()
         self._message_formatter = MessageFormatter(self._wrapper, add_channel_name=True)
         self._thread_formatter = ThreadFormatter(self._wrapper, add_channel_name=True)
 
     def add_channel(self, channel):
-        all_messages = channel.all_messages.values()
-        if not all_messages:
+        if not channel.message_count:
             return
 
-        self.total_messages += len(all_messages)
+        self.total_messages += channel.message_count
+
+        all_messages = channel.all_messages.values()
 
         messages = self._filter.filter_messages(all_messages)
         threads = self._filter.filter_threads(all_messages)
 
         if len(messages) or len(threads) or self.options.debug:
             print(self._channel_report_template.format(name=channel.name, messages=len(messages), threads=len(threads),
-                                                       total=len(channel.all_messages)))
-        self._messages.extend(messages)
-        self._threads.extend(threads)
+                                                       total=channel.message_count))
+        self.filtered_messages += len(messages)
+        self.total_threads += len(threads)
+        if self._top:
+            self._keep_top(self._messages, messages, key=lambda message: message.reaction_count)
+            self._keep_top(self._threads, threads, key=lambda message: message.threaded_reaction_count)
+        else:
+            self._messages.extend(messages)
+            self._threads.extend(threads)
         self.total_channels += 1
 
+    def _keep_top(self, heap, messages, key):
+        # Ties go to the later message, as they do when the sorter reverses a full list
+        for message in messages:
+            entry = (key(message), next(self._order), message)
+            if len(heap) < self._top:
+                heapq.heappush(heap, entry)
+            else:
+                heapq.heappushpop(heap, entry)
+
     def _write_messages(self):
         with open(self._filename("messages"), 'w') as f:
             self._sorter.sort_messages(self._messages)
@@ -599,43 +1258,212 @@ class ConsolidatedWriter(Writer):
                 f.write("\n")
 
     def finalize(self):
-        users = {}
-        annotate_messages(self._messages, users)
-        annotate_messages(self._threads, users)
+        if self._top:
+            self._messages = [entry[-1] for entry in sorted(self._messages)]
+            self._threads = [entry[-1] for entry in sorted(self._threads)]
+        annotate_messages(self._messages + self._threads, self._users, workers=self.options.parsed_args.workers)
 
         self._write_messages()
         self._write_threads()
 
         if self.total_channels > 1:
             print("\nFound {0} potential messages and {1} long threads across {2} channels and {3} messages".format(
-                len(self._messages), len(self._threads), writer.total_channels, writer.total_messages))
+                self.filtered_messages, self.total_threads, self.total_channels, self.total_messages))
+
+
+class JsonlWriter(Writer):
+    """
+    Streams a JSON record for each message and thread to a single file as each channel is added
+    """
+
+    def __init__(self, message_filter, sorter, options, users, folder_name=None):
+        super().__init__(message_filter, sorter, options, users, folder_name)
+        self.filtered_messages = 0
+        self.total_threads = 0
+        self._formatter = RecordFormatter()
+        self._file = open(self._filename("digest", extension=".jsonl"), 'w')
+
+    def add_channel(self, channel):
+        if not channel.message_count:
+            return
+
+        self.total_messages += channel.message_count
+
+        all_messages = channel.all_messages.values()
+
+        messages = self._filter.filter_messages(all_messages)
+        threads = self._filter.filter_threads(all_messages)
+        if len(messages) or len(threads) or self.options.debug:
+            print(self._channel_report_template.format(name=channel.name, messages=len(messages), threads=len(threads),
+                                                       total=channel.message_count))
+        self.filtered_messages += len(messages)
+        self.total_threads += len(threads)
+        self.total_channels += 1
+        if not (messages or threads):
+            return
+
+        annotate_messages(messages + threads, self._users, workers=self.options.parsed_args.workers)
+        self._sorter.sort_messages(messages)
+        for message in messages:
+            self._file.write(self._formatter.format(message, "message"))
+        self._sorter.sort_threads(threads)
+        for message in threads:
+            self._file.write(self._formatter.format(message, "thread"))
+        # Let readers start on what we have so far
+        self._file.flush()
+
+    def finalize(self):
+        self._file.close()
+        if self.total_channels > 1:
+            print("\nFound {0} potential messages and {1} long threads across {2} channels and {3} messages".format(
+                self.filtered_messages, self.total_threads, self.total_channels, self.total_messages))
 
 
-def annotate_messages(messages, users):
+def annotate_messages(messages, users, workers=1):
+    """
+    Fills in the author and link of each message.  Each distinct user and link is looked up once, up to
+    `workers` at a time, before any message is filled in.
+    """
+    if not messages:
+        return
+    started = time.monotonic()
+    api = messages[0].api
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        names = {}
+        urls = {}
+        for message in messages:
+            if message.user_id not in names:
+                names[message.user_id] = executor.submit(users.name, message.user_id)
+            if message.link_key not in urls:
+                urls[message.link_key] = executor.submit(api.getPermalink, *message.link_key)
+        # Stop at the first failure rather than working through every remaining lookup
+        lookups = list(names.values()) + list(urls.values())
+        concurrent.futures.wait(lookups, return_when=concurrent.futures.FIRST_EXCEPTION)
+        for lookup in lookups:
+            lookup.cancel()
     for message in messages:
-        message.annotate(users)
+        message.username = names[message.user_id].result()
+        message.url = urls[message.link_key].result()
+    if api.debug:
+        print("Annotated {0} messages ({1} users, {2} links) in {3:.2f} seconds".format(
+            len(messages), len(names), len(urls), time.monotonic() - started))
 
 
-if __name__ == '__main__':
-    options = Options()
-    options.store_args()
+def fetch_channels(channels, windows, workers=1, store=None, message_filter=None, thread_filter=None):
+    """
+    Fetches the messages for each channel, yielding a list of the channel's messages per window for each
+    channel in their original order.  With more than one worker, a bounded number of channels are fetched
+    ahead on a thread pool sharing the same api.
+    """
+    if workers <= 1:
+        for channel in channels:
+            yield channel.fetch_windows(windows, store, message_filter, thread_filter)
+        return
 
-    print("Looking for messages from {0} to {1}".format(options.start_date.isoformat(), options.end_date.isoformat()))
+    def fetch(channel):
+        return channel.fetch_windows(windows, store, message_filter, thread_filter)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = collections.deque()
+        for channel in channels:
+            pending.append(executor.submit(fetch, channel))
+            if len(pending) >= workers * 2:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
 
-    api = ApiWrapper(options)
+
+def create_digest(options, api):
+    print("Looking for messages from {0} to {1}".format(options.start_date.isoformat(), options.end_date.isoformat()))
 
     filter = Filter(options)
     channels = filter.filter_channels(api.get_channels())
     print("Found {0} channels".format(len(channels)))
+    if options.parsed_args.skip_inactive:
+        activity = ChannelActivity(api, options.parsed_args.activity_cache)
+        channels = activity.filter_channels(channels, options.start_timestamp.timestamp(),
+                                            options.end_timestamp.timestamp(), workers=options.parsed_args.workers)
+        print("Kept {0} channels with messages since {1}".format(len(channels), options.start_date.isoformat()))
     if not channels:
-        sys.exit()
+        return
+
+    users = UserDirectory(api, cache_file=options.parsed_args.user_cache,
+                          ttl=options.parsed_args.user_cache_hours * 60 * 60)
+    # A backfill writes each week to a folder named for its start
+    backfill = len(options.weeks) > 1
+    writers = []
+    for start_date, end_date in options.weeks:
+        folder_name = start_date.isoformat() if backfill else None
+        writer = ConsolidatedWriter(message_filter=filter, sorter=MessageSorter(), options=options, users=users,
+                                    folder_name=folder_name)
+        if options.parsed_args.format == 'jsonl':
+            writer = JsonlWriter(message_filter=filter, sorter=MessageSorter(), options=options, users=users,
+                                 folder_name=folder_name)
+        elif options.parsed_args.split_by_channels:
+            writer = ChannelWriter(message_filter=filter, sorter=MessageSorter(), options=options, users=users,
+                                   folder_name=folder_name)
+        writers.append(writer)
+    store = None
+    if options.parsed_args.store:
+        store = MessageStore(options.parsed_args.store, options.parsed_args.refresh_hours * 60 * 60)
+
+    snapshot = None
+    if options.parsed_args.snapshot:
+        snapshot = Snapshot(options.parsed_args.snapshot)
+
+    checkpoint = Checkpoint(options.parsed_args.checkpoint, run=options.run_key)
+    if options.parsed_args.resume and os.path.exists(checkpoint.filename):
+        finished = checkpoint.resume(api, channels)
+        print("Resuming after {0} finished channels".format(len(finished)))
+        for windows in finished:
+            for writer, channel in zip(writers, windows):
+                writer.add_channel(channel)
+        done = {windows[0].id for windows in finished}
+        channels = [channel for channel in channels if channel.id not in done]
+    else:
+        if options.parsed_args.resume:
+            print("Nothing to resume from {0}; starting from the beginning".format(checkpoint.filename))
+        checkpoint.start()
+
+    started = time.monotonic()
+    try:
+        for windows in fetch_channels(channels, options.windows, workers=options.parsed_args.workers, store=store,
+                                      message_filter=filter if options.parsed_args.streaming else None,
+                                      thread_filter=filter):
+            for writer, channel in zip(writers, windows):
+                writer.add_channel(channel)
+            if snapshot:
+                for window, channel in enumerate(windows):
+                    snapshot.add_channel(channel, window)
+            checkpoint.add(windows, filter, api)
+            for channel in windows:
+                channel.reset()
+        if options.debug:
+            print("Fetched {0} channels in {1:.2f} seconds".format(len(channels), time.monotonic() - started))
+
+        for writer in writers:
+            if backfill:
+                print("\nWeek of {0}:".format(writer.folder_name))
+            writer.finalize()
+        if snapshot:
+            snapshot.save()
+            print("Saved a snapshot to {0}; rerun with --sweep {0} to try other thresholds".format(snapshot.filename))
+    except BaseException:
+        checkpoint.save_links(api)
+        print("Saved progress to {0}; rerun with --resume to continue".format(checkpoint.filename))
+        raise
+    checkpoint.finish()
 
-    writer = ConsolidatedWriter(message_filter=filter, sorter=MessageSorter(), options=options)
-    if options.parsed_args.split_by_channels:
-        writer = ChannelWriter(message_filter=filter, sorter=MessageSorter(), options=options)
-    for channel in channels:
-        channel.fetch_messages(options.start_timestamp, options.end_timestamp)
-        writer.add_channel(channel)
-        channel.reset()
 
-    writer.finalize()
+if __name__ == '__main__':
+    options = Options()
+    options.store_args()
+
+    if options.parsed_args.sweep:
+        print_sweep(options)
+    else:
+        api = ApiWrapper(options)
+        try:
+            create_digest(options, api)
+        finally:
+            report_metrics(api.metrics, options.parsed_args.stats, options.parsed_args.stats_json)